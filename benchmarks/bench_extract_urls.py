@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the throughput, in messages per second, of decoding synthetic newsletters and extracting their
+links with `UrlExtractor`, against the word-splitting extraction it replaced. No links are validated.
+Run from the project root with `python -m benchmarks.bench_extract_urls`.
+"""
+import re
+import time
+
+import click
+
+from benchmarks.synthetic import make_mailbox
+from src.data.extract_hyperlinks import InboxDelta
+from src.data.extract_urls import UrlExtractor
+
+
+def reference_extract_urls(string_msg_dict):
+    """ The link extraction of `InboxDelta.parse` this stage replaced, kept for comparison. """
+    parsed_list = []
+    for key, msg_string in string_msg_dict.items():
+        for link in [word for word in msg_string.split(" ") if 'http' in word]:
+            if re.match(r'.*\(http.*://', link):
+                link = link.split(sep='(')[1]
+                link = link.rsplit(sep=')')[0]
+            parsed_list.append(link)
+    checklist = []
+    for link in parsed_list:
+        if (link not in checklist) and ('accounts.google.com' not in link) and ('subscr' not in link) and \
+                ('aiohttp' not in link) and ('http' in link) and ('://' in link):
+            checklist.append(link)
+    return checklist
+
+
+def compiled_extract_urls(string_msg_dict, extractor):
+    return list(dict.fromkeys(link for msg_string in string_msg_dict.values()
+                              for link in extractor.extract(msg_string)))
+
+
+@click.command()
+@click.option('--messages', default=2000, help='Number of synthetic newsletters.')
+@click.option('--links', default=40, help='Links per newsletter.')
+def main(messages, links):
+    mailbox = make_mailbox(messages, n_links=links)
+    delta = InboxDelta.__new__(InboxDelta)
+
+    start = time.perf_counter()
+    plain = delta.extract(mailbox)
+    reference = reference_extract_urls(plain)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bodies = delta.extract(mailbox, include_html=True)
+    compiled = compiled_extract_urls(bodies, UrlExtractor())
+    compiled_time = time.perf_counter() - start
+
+    print(f'reference (text/plain only): {messages / reference_time:10.0f} msg/s, {len(reference)} links')
+    print(f'compiled (plain + html):     {messages / compiled_time:10.0f} msg/s, {len(compiled)} links')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks `LinkParser.parse_text` against the original html5lib implementation on synthetic pages.
+Run from the project root with `python -m benchmarks.bench_parse_text`.
+"""
+import random
+import time
+from string import punctuation
+
+import click
+from bs4 import BeautifulSoup
+
+from src.data.extract_text import parse_corpus
+
+WORDS = ['model', 'training', 'data', 'neural', 'network', 'the', 'of', 'language', 'paper', 'results',
+         'benchmark', 'attention', 'transformer', 'learning', 'a', 'new', 'with', 'and', 'in', 'gradient']
+
+
+def make_page(n_paragraphs, rng):
+    paragraphs = []
+    for _ in range(n_paragraphs):
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+        paragraphs.append(f'<div class="post-body"><p>{sentence}.</p><a href="https://example.com/{rng.random()}">'
+                          f'read more</a><script>var x = {{"a": [1, 2, 3]}};</script></div>')
+    return f'<html><head><title>Page</title></head><body>{"".join(paragraphs)}</body></html>'
+
+
+def reference_parse_text(corpus):
+    """ The implementation of `LinkParser.parse_text` this engine replaced, kept for comparison. """
+    for link, text_tpl in corpus.items():
+        if 'html' in text_tpl[0]:
+            tmp_soup = BeautifulSoup(text_tpl[1], "html5lib")
+            tmp_output = ''
+            for line in tmp_soup.prettify().split("\n"):
+                punctset = [f for f in line if f in punctuation]
+                punctuation_counts = len(punctset)
+                if punctuation_counts / (len(line)+.0000000000000000001) < .1:
+                    tmp_output = tmp_output + line
+            corpus[link] = tmp_output
+    return corpus
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+@click.command()
+@click.option('--documents', default=200, help='Number of synthetic pages.')
+@click.option('--paragraphs', default=50, help='Paragraphs per page.')
+@click.option('--processes', default=4, help='Worker processes for the process pool mode.')
+def main(documents, paragraphs, processes):
+    rng = random.Random(0)
+    pages = {f'https://example.com/{i}': ('text/html; charset=utf-8', make_page(paragraphs, rng))
+             for i in range(documents)}
+
+    reference_time, reference = timed(reference_parse_text, dict(pages))
+    serial_time, serial = timed(parse_corpus, dict(pages))
+    pool_time, pool = timed(parse_corpus, dict(pages), processes=processes)
+
+    print(f'equivalent output: {reference == serial == pool}')
+    print(f'reference (html5lib):   {reference_time:8.2f}s')
+    print(f'engine, 1 process:      {serial_time:8.2f}s  ({reference_time / serial_time:.1f}x)')
+    print(f'engine, {processes} processes:    {pool_time:8.2f}s  ({reference_time / pool_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
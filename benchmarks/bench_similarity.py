@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the recall and query latency of `SimilarityIndex.search` on the TF-IDF features of a synthetic corpus of
+articles that mix a few topics each, for several projection sizes (`dim`, `hashes_per_feature`) and numbers of probed
+lists (`nprobe`). The recall@k is the share of the exact top k by TF-IDF cosine similarity that is found, so it
+includes the loss of both the random projection and the inverted file. To tell the two apart, the recall of exact
+search over the projected vectors is given too, as is the recall of the inverted file against that (`ivf_recall`).
+The mean TF-IDF similarity of the neighbours found, as a share of that of the exact neighbours, shows how much worse
+the misses are. Writes the results as JSON, to reports/benchmarks/similarity-<commit>.json by default.
+Run from the project root with `python -m benchmarks.bench_similarity`.
+"""
+import json
+import os
+import random
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from benchmarks.run_benchmarks import git_commit, timed
+from benchmarks.synthetic import make_articles
+from src.data.corpus_store import content_hash
+from src.features.build_features import FeatureBuilder
+from src.features.similarity_index import SimilarityIndex
+
+
+def recall(found, expected):
+    """
+    Returns:
+        the mean share of the content hashes in every list in `expected` that are in the matching list in `found`.
+    """
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected) if e]))
+
+
+@click.command()
+@click.option('--documents', default=20000, help='Number of synthetic articles to index.')
+@click.option('--queries', default=200, help='Number of synthetic articles to query with, not in the index.')
+@click.option('--topics', default=200, help='Number of topics of the articles.')
+@click.option('-k', default=10, help='Number of neighbours per query.')
+@click.option('--lists', default=128, help='Number of lists of the index.')
+@click.option('--dims', default='128,256,512', help='Comma separated dimensions to project the vectors to.')
+@click.option('--hashes', default='1,4', help='Comma separated numbers of dimensions every feature is hashed to.')
+@click.option('--nprobes', default='1,2,4,8,16,32', help='Comma separated numbers of lists to scan per query.')
+@click.option('--output', default=None, type=click.Path(), help='Where to write the JSON report.')
+def main(documents, queries, topics, k, lists, dims, hashes, nprobes, output):
+    rng = random.Random(0)
+    articles = make_articles(documents + queries, rng, n_topics=topics)
+    report = {'commit': git_commit(), 'parameters': {'documents': documents, 'queries': queries, 'topics': topics,
+                                                     'k': k, 'lists': lists}, 'results': []}
+
+    with tempfile.TemporaryDirectory() as directory:
+        features = FeatureBuilder(os.path.join(directory, 'features'))
+        features.build({'content_hash': content_hash(text), 'text': text} for text in articles[:documents])
+        query_matrix = features.transform(articles[documents:])
+        content_hashes, matrix = features.load()
+        similarities = (matrix @ query_matrix.T).T.toarray()
+        exact_tfidf = [[content_hashes[i] for i in np.argsort(-row)[:k]] for row in similarities]
+        rows = {h: i for i, h in enumerate(content_hashes)}
+
+        def mean_similarity(neighbours):
+            return np.mean([similarities[query, [rows[h] for h in found]].mean()
+                            for query, found in enumerate(neighbours)])
+
+        def score(found, exact):
+            return {'recall': round(recall(found, exact_tfidf), 4), 'ivf_recall': round(recall(found, exact), 4),
+                    'similarity_ratio': round(float(mean_similarity(found) / mean_similarity(exact_tfidf)), 4)}
+
+        for dim in (int(dim) for dim in dims.split(',')):
+            for hashes_per_feature in (int(h) for h in hashes.split(',')):
+                index = SimilarityIndex(os.path.join(directory, f'similarity-{dim}-{hashes_per_feature}'), dim=dim,
+                                        n_lists=lists, hashes_per_feature=hashes_per_feature)
+                build_seconds, added = timed(index.build, features)
+                vectors = index.project(query_matrix)
+                seconds, exact = timed(index.exact_search, vectors, k=k)
+                exact = [[match_hash for match_hash, _ in matches] for matches in exact]
+                result = {'dim': dim, 'hashes_per_feature': hashes_per_feature, 'nprobe': None, **score(exact, exact),
+                          'ms_per_query': round(seconds / queries * 1000, 3), 'build_seconds': round(build_seconds, 3)}
+                report['results'].append(result)
+                print(f"dim {dim:5} x {hashes_per_feature}: indexed {added} documents in {build_seconds:.2f}s; exact "
+                      f"search recall@{k} {result['recall']:.3f}, {result['ms_per_query']:.3f}ms per query")
+
+                for nprobe in (int(nprobe) for nprobe in nprobes.split(',')):
+                    found, latencies = [], []
+                    for vector in vectors:
+                        start = time.perf_counter()
+                        matches = index.search_vectors(vector, k=k, nprobe=nprobe)[0]
+                        latencies.append((time.perf_counter() - start) * 1000)
+                        found.append([match_hash for match_hash, _ in matches])
+                    result = {'dim': dim, 'hashes_per_feature': hashes_per_feature, 'nprobe': nprobe,
+                              **score(found, exact), 'ms_p50': round(float(np.percentile(latencies, 50)), 3),
+                              'ms_p95': round(float(np.percentile(latencies, 95)), 3)}
+                    report['results'].append(result)
+                    print(f"  nprobe {nprobe:4}  recall@{k} {result['recall']:.3f}  (IVF {result['ivf_recall']:.3f}, "
+                          f"similarity {result['similarity_ratio']:.3f})  "
+                          f"p50 {result['ms_p50']:7.3f}ms  p95 {result['ms_p95']:7.3f}ms")
+
+    output = output or os.path.join('reports', 'benchmarks', f'similarity-{report["commit"] or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'\nwrote {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the data pipeline end to end at several scales, without touching GMail or the web: a synthetic
+mailbox is served by a `FakeGmailService`, and the links in it point at a local `PageServer`. Times fetching
+the messages, `InboxDelta.extract`, `InboxDelta.parse`, `LinkParser.retrieve_text` and `LinkParser.parse_text`,
+and writes the results as JSON (to reports/benchmarks/<commit>.json by default), so that runs on different
+commits can be compared with `--compare`.
+Run from the project root with `python -m benchmarks.run_benchmarks`, or `make benchmark`.
+"""
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import click
+
+from benchmarks.synthetic import FakeGmailService, PageServer, make_mailbox
+from src.data.crawler import Crawler
+from src.data.extract_hyperlinks import InboxDelta
+from src.data.fetch import Fetcher
+from src.data.get_gmails import GMailGetter
+from src.data.metrics import METRICS
+from src.data.retrieve_text_from_link import LinkParser
+from src.data.url_cache import UrlStatusCache
+from src.data.validate_links import LinkValidator
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{commit}-dirty' if dirty else commit
+
+
+def run_scale(n_messages, server, links, workers, processes, gmail_latency, cache_dir):
+    """
+    Runs every benchmark once on a synthetic mailbox of `n_messages` newsletters.
+
+    Returns:
+        a list of results, dicts with the `benchmark`, `scale`, `seconds`, the number of `items` processed and
+        the `items_per_second`.
+    """
+    mailbox = make_mailbox(n_messages, n_links=links, base_url=server.url)
+    results = []
+
+    def record(benchmark, seconds, items):
+        results.append({'benchmark': benchmark, 'scale': n_messages, 'seconds': round(seconds, 4), 'items': items,
+                        'items_per_second': round(items / seconds, 2) if seconds > 0 else None})
+
+    getter = GMailGetter(run_pipeline=False, service=FakeGmailService(mailbox, latency=gmail_latency))
+    seconds, fetched = timed(lambda: list(getter.fetch_messages(getter.get_unread_messages())))
+    record('GMailGetter.fetch_messages', seconds, len(fetched))
+
+    # Every host is the local server, so lift the per-host limits to measure throughput rather than politeness.
+    validator = LinkValidator(max_workers=workers, per_host_limit=workers,
+                              cache=UrlStatusCache(os.path.join(cache_dir, f'url_status_{n_messages}.sqlite')))
+    delta = InboxDelta(mailbox, validator=validator, run_pipeline=False)
+    seconds, string_msgs = timed(delta.extract, mailbox, processes=processes, include_html=True)
+    record('InboxDelta.extract', seconds, len(string_msgs))
+
+    seconds, hyperlinks = timed(delta.parse, string_msgs)
+    record('InboxDelta.parse', seconds, len(delta.canonical_links))
+
+    crawler = Crawler(fetcher=Fetcher(pool_size=workers), max_workers=workers, per_domain_limit=workers,
+                      per_domain_delay=0)
+    parser = LinkParser(hyperlinks, run_pipeline=False, crawler=crawler)
+    seconds, corpus = timed(parser.retrieve_text, hyperlinks, fetch_urls=delta.fetch_urls)
+    record('LinkParser.retrieve_text', seconds, len(corpus))
+
+    seconds, _ = timed(parser.parse_text, dict(corpus), processes=processes)
+    record('LinkParser.parse_text', seconds, len(corpus))
+    return results
+
+
+def compare(report, baseline):
+    """
+    Prints the ratio of the time every benchmark took in `report` to the time it took in `baseline`.
+    """
+    before = {(result['benchmark'], result['scale']): result['seconds'] for result in baseline['results']}
+    print(f"\ncompared to {baseline.get('commit')}:")
+    for result in report['results']:
+        key = (result['benchmark'], result['scale'])
+        if before.get(key):
+            print(f"{result['benchmark']:28} {result['scale']:6}  {result['seconds'] / before[key]:6.2f}x the time")
+
+
+@click.command()
+@click.option('--scales', default='10,50,200', help='Comma separated numbers of synthetic newsletters.')
+@click.option('--links', default=20, help='Links per newsletter.')
+@click.option('--page-bytes', default=20000, help='Size of the pages served by the local server.')
+@click.option('--latency', default=.02, help='Seconds the local server takes to answer a request.')
+@click.option('--gmail-latency', default=.05, help='Seconds a round trip to the fake GMail service takes.')
+@click.option('--workers', default=16, help='Threads for validating and retrieving links.')
+@click.option('--processes', default=None, type=int, help='Worker processes for decoding and parsing.')
+@click.option('--output', default=None, type=click.Path(), help='Where to write the JSON report.')
+@click.option('--compare', 'baseline_file', default=None, type=click.Path(exists=True),
+              help='A JSON report of an earlier run to compare with.')
+def main(scales, links, page_bytes, latency, gmail_latency, workers, processes, output, baseline_file):
+    commit = git_commit()
+    parameters = {'links': links, 'page_bytes': page_bytes, 'latency': latency, 'gmail_latency': gmail_latency,
+                  'workers': workers, 'processes': processes}
+    report = {'commit': commit, 'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'parameters': parameters, 'results': [], 'metrics': {}}
+
+    with PageServer(page_bytes=page_bytes, latency=latency) as server, tempfile.TemporaryDirectory() as cache_dir:
+        for scale in (int(scale) for scale in scales.split(',')):
+            METRICS.reset()
+            for result in run_scale(scale, server, links, workers, processes, gmail_latency, cache_dir):
+                report['results'].append(result)
+                print(f"{result['benchmark']:28} {scale:6}  {result['seconds']:8.3f}s  "
+                      f"{result['items']:7} items  {result['items_per_second'] or 0:10.1f}/s")
+            # The counters and HTTP latencies behind the timings, e.g. to tell network from parsing time.
+            report['metrics'][scale] = METRICS.report()
+
+    output = output or os.path.join('reports', 'benchmarks', f'{commit or "unknown"}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'\nwrote {output}')
+
+    if baseline_file is not None:
+        with open(baseline_file) as file:
+            compare(report, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
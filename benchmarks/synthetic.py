@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic stand-ins for the GMail API and the web, used by the benchmarks.
+"""
+import base64
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+WORDS = ['model', 'training', 'data', 'neural', 'network', 'the', 'of', 'language', 'paper', 'results',
+         'benchmark', 'attention', 'transformer', 'learning', 'a', 'new', 'with', 'and', 'in', 'gradient']
+EXCLUDED_LINKS = ['https://accounts.google.com/signin', 'https://newsletter.example.com/unsubscribe?id=1']
+
+
+def make_links(n_links, rng, base_url='https://example.com'):
+    return [f'{base_url}/articles/{rng.randrange(10 ** 6)}?utm_source=newsletter&utm_medium=email'
+            for _ in range(n_links)] + EXCLUDED_LINKS
+
+
+def make_raw_message(msg_id, rng, n_words=300, n_links=20, multipart=True, base_url='https://example.com'):
+    """
+    Generates a newsletter in the raw format of the GMail API: a dict with the base64url encoded message
+    as `raw`. Multipart messages have a text/plain and a text/html alternative that both link to the
+    same `n_links` articles; plain messages only have the text/plain body.
+    """
+    links = make_links(n_links, rng, base_url)
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    step = max(1, n_words // len(links))
+    plain = []
+    html = []
+    for i, word in enumerate(words):
+        plain.append(word)
+        html.append(word)
+        if i % step == 0 and i // step < len(links):
+            link = links[i // step]
+            plain.append(f'({link})')
+            html.append(f'<a href="{link.replace("&", "&amp;")}">{word}</a>')
+    plain_text = '\r\n'.join(' '.join(plain[i:i + 12]) for i in range(0, len(plain), 12))
+    if multipart:
+        message = MIMEMultipart('alternative')
+        message.attach(MIMEText(plain_text, 'plain', 'utf-8'))
+        message.attach(MIMEText(f'<html><body><p>{" ".join(html)}</p></body></html>', 'html', 'utf-8'))
+    else:
+        message = MIMEText(plain_text, 'plain', 'utf-8')
+    message['Subject'] = f'Newsletter {msg_id}'
+    message['From'] = 'newsletter@example.com'
+    return {'id': msg_id, 'threadId': msg_id, 'internalDate': str(1600000000000 + int(msg_id, 16)),
+            'raw': base64.urlsafe_b64encode(message.as_bytes()).decode('ascii')}
+
+
+def make_mailbox(n_messages, seed=0, multipart_ratio=.7, **kwargs):
+    """
+    Generates a dict {msg_id: raw_msg} of `n_messages` synthetic newsletters.
+    """
+    rng = random.Random(seed)
+    mailbox = {}
+    for i in range(n_messages):
+        msg_id = f'{i + 1:016x}'
+        mailbox[msg_id] = make_raw_message(msg_id, rng, multipart=rng.random() < multipart_ratio, **kwargs)
+    return mailbox
+
+
+def make_page(n_bytes, rng):
+    """
+    Generates an HTML article of about `n_bytes`, with paragraphs of running text between markup, links and
+    scripts, like the pages newsletters link to.
+    """
+    paragraphs = []
+    size = 0
+    while size < n_bytes:
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 80)))
+        paragraph = (f'<div class="post-body"><p>{sentence}.</p><a href="https://example.com/{rng.random()}">'
+                     f'read more</a><script>var x = {{"a": [1, 2, 3]}};</script></div>')
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    return f'<html><head><title>Page</title></head><body>{"".join(paragraphs)}</body></html>'
+
+
+def make_articles(n_articles, rng, n_topics=200, n_words=200, vocabulary_size=20000, topic_words=300,
+                  topic_share=.8, topics_per_article=2):
+    """
+    Generates the parsed texts of `n_articles` articles about `n_topics` topics, for benchmarks that need
+    a corpus with similar and dissimilar documents. Every topic prefers its own `topic_words` words of a
+    synthetic vocabulary. An article draws `topic_share` of its words from `topics_per_article` random
+    topics, in random proportions, and the rest from the whole vocabulary, so articles are more or less
+    similar rather than falling into clearly separated clusters.
+    """
+    vocabulary = [f'w{i:05d}' for i in range(vocabulary_size)]
+    topics = [rng.sample(vocabulary, topic_words) for _ in range(n_topics)]
+    weights = [1 / (rank + 1) for rank in range(topic_words)]
+    articles = []
+    for _ in range(n_articles):
+        article_topics = rng.sample(topics, topics_per_article)
+        shares = [rng.random() for _ in article_topics]
+        words = []
+        for topic, share in zip(article_topics, shares):
+            words += rng.choices(topic, weights=weights, k=round(n_words * topic_share * share / sum(shares)))
+        words += rng.choices(vocabulary, k=n_words - len(words))
+        rng.shuffle(words)
+        articles.append(' '.join(words))
+    return articles
+
+
+class PageServer:
+    """
+    A local HTTP server that stands in for the web: answers every GET with an HTML page of about
+    `page_bytes`, and every HEAD with its headers, after `latency` seconds. Pages are generated
+    once and served by path, so repeated requests get the same body. Use as a context manager;
+    `url` is the base URL to point synthetic links at.
+    """
+
+    def __init__(self, page_bytes=20000, latency=0.05, n_pages=64, seed=0):
+        rng = random.Random(seed)
+        pages = [make_page(page_bytes, rng).encode('utf-8') for _ in range(n_pages)]
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self, send_body):
+                time.sleep(latency)
+                server.requests += 1
+                body = pages[zlib.crc32(self.path.encode('utf-8')) % len(pages)]
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self._respond(True)
+
+            def do_HEAD(self):
+                self._respond(False)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}'
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Request:
+    def __init__(self, service, execute):
+        self._service = service
+        self._execute = execute
+
+    def execute(self):
+        self._service._round_trip()
+        return self._execute()
+
+
+class _BatchRequest:
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request, request_id))
+
+    def execute(self):
+        # One round trip for the whole batch, like the batch endpoint.
+        self._service._round_trip()
+        for request, request_id in self._requests:
+            try:
+                response = request._execute()
+            except Exception as error:
+                self._callback(request_id, None, error)
+            else:
+                self._callback(request_id, response, None)
+
+
+class FakeGmailService:
+    """
+    An in-memory stand-in for the GMail API `service` object, serving a synthetic mailbox (see `make_mailbox`)
+    through the calls `GMailGetter` makes: listing unread messages page by page, history since a history id,
+    batched gets in raw format, and batchModify. Every HTTP round trip takes `latency` seconds and is counted
+    in `round_trips`. Messages are added to the history in the order of the mailbox, one history id each.
+    """
+
+    def __init__(self, mailbox, latency=0.0):
+        self.mailbox = mailbox
+        self.unread = set(mailbox)
+        self.latency = latency
+        self.round_trips = 0
+        self._history_ids = {msg_id: i + 1 for i, msg_id in enumerate(mailbox)}
+        self._lock = threading.Lock()
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        time.sleep(self.latency)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return _History(self)
+
+    def new_batch_http_request(self, callback=None):
+        return _BatchRequest(self, callback)
+
+    def getProfile(self, userId):
+        return _Request(self, lambda: {'emailAddress': 'me@example.com', 'historyId': str(len(self.mailbox))})
+
+    def list(self, userId, labelIds=None, maxResults=100, pageToken=None):
+        def execute():
+            ids = [msg_id for msg_id in self.mailbox if msg_id in self.unread]
+            start = int(pageToken or 0)
+            results = {'messages': [{'id': msg_id, 'threadId': msg_id} for msg_id in ids[start:start + maxResults]],
+                       'resultSizeEstimate': len(ids)}
+            if start + maxResults < len(ids):
+                results['nextPageToken'] = str(start + maxResults)
+            return results
+        return _Request(self, execute)
+
+    def get(self, userId, id, format='full'):
+        return _Request(self, lambda: self.mailbox[id])
+
+    def batchModify(self, userId, body):
+        def execute():
+            if 'UNREAD' in body.get('removeLabelIds', []):
+                self.unread.difference_update(body['ids'])
+            return {}
+        return _Request(self, execute)
+
+
+class _History:
+    def __init__(self, service):
+        self._service = service
+
+    def list(self, userId, startHistoryId, historyTypes=None, labelId=None, maxResults=100, pageToken=None):
+        service = self._service
+
+        def execute():
+            added = [msg_id for msg_id, history_id in service._history_ids.items() if history_id > int(startHistoryId)]
+            start = int(pageToken or 0)
+            results = {'history': [{'id': str(service._history_ids[msg_id]),
+                                    'messagesAdded': [{'message': {'id': msg_id, 'threadId': msg_id}}]}
+                                   for msg_id in added[start:start + maxResults]],
+                       'historyId': str(len(service.mailbox))}
+            if start + maxResults < len(added):
+                results['nextPageToken'] = str(start + maxResults)
+            return results
+        return _Request(service, execute)
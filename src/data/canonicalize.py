@@ -0,0 +1,127 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+import requests
+from src.data.fetch import make_session
+from src.data.metrics import METRICS
+
+# Query parameters that only identify the newsletter, campaign or reader a click came from.
+TRACKING_PARAMS = re.compile(r'^(utm_\w+|mc_cid|mc_eid|fbclid|gclid|dclid|msclkid|yclid|_hsenc|_hsmi'
+                             r'|hsCtaTracking|mkt_tok|vero_conv|vero_id|oly_anon_id|oly_enc_id|rb_clickid|s_cid'
+                             r'|ref_src|ck_subscriber_id)$', re.IGNORECASE)
+# Hosts of click-tracking redirectors used by newsletter services; links to them are resolved to where they lead.
+TRACKER_HOSTS = re.compile(r'(^|\.)(list-manage\.com|mailchi\.mp|sendgrid\.net|mailgun\.org|mlsend\.com'
+                           r'|convertkit-mail\d*\.com|bit\.ly|t\.co|lnkd\.in|tinyurl\.com'
+                           r'|hubspotlinks\.com|mjt\.lu|rs6\.net|cmail\d+\.com|createsend\d*\.com)$'
+                           r'|^(click|clicks|links?|track|trk|email|e|go)\.', re.IGNORECASE)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url):
+    """
+    Normalizes a URL so that links to the same page compare equal: lowercases the scheme and host,
+    drops user info, default ports, the fragment, tracking query parameters and a trailing slash.
+    The other query parameters are kept as they are. The canonical URL is a key to deduplicate
+    links by, not the URL to request: the server may well tell the difference.
+
+    Args:
+        url: the URL to canonicalize.
+
+    Returns:
+        the canonical URL as a string, or `url` itself if it is malformed, e.g. has an invalid port.
+    """
+    url = url.strip()
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    path = parts.path.rstrip('/') if parts.path not in ('', '/') else ''
+    query = '&'.join(pair for pair in parts.query.split('&')
+                     if pair and not TRACKING_PARAMS.match(unquote_plus(pair.split('=', 1)[0])))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+class UrlCanonicalizer:
+    """
+    Maps the links found in newsletters to canonical URLs, so that the same article linked from
+    several newsletters is validated and retrieved only once.
+
+    Links to click-tracking redirectors (hosts matching `tracker_hosts`) are first resolved to the
+    URL they redirect to, concurrently on `max_workers` threads. Resolved trackers are stored in
+    `cache`, a `UrlStatusCache` that can be shared with the `LinkValidator`, so a tracker link is
+    only resolved once. The resolved URLs are the ones to request (see `resolve_all`); they are
+    canonicalized with `canonicalize_url` to deduplicate them.
+    """
+
+    def __init__(self, cache=None, session=None, max_workers=16, timeout=10, tracker_hosts=TRACKER_HOSTS):
+        self.cache = cache
+        self.session = session if session is not None else make_session(max_workers)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.tracker_hosts = tracker_hosts
+
+    def is_tracker(self, url):
+        return self.tracker_hosts.search(urlsplit(url).hostname or '') is not None
+
+    def resolve(self, url):
+        """
+        Follows the redirects of a tracker link, using the cache where possible.
+
+        Args:
+            url: the tracker link to resolve.
+
+        Returns:
+            the URL the link finally leads to, or `url` itself if it could not be resolved.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None:
+                return cached[1] or url
+        METRICS.inc('tracker_links_resolved')
+        status_code, final_url = None, None
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            if response.status_code != 200:
+                response = self.session.get(url, allow_redirects=True, timeout=self.timeout, stream=True)
+                response.close()
+            status_code, final_url = response.status_code, response.url
+        except (requests.RequestException, ValueError):
+            pass
+        if self.cache is not None:
+            self.cache.put(url, status_code, final_url)
+        return final_url or url
+
+    def resolve_all(self, links):
+        """
+        Resolves the tracker links among a list of links.
+
+        Args:
+            links: an iterable of links, possibly containing duplicates.
+
+        Returns:
+            a dict {link: URL to request}, in order of first appearance of the links; links that are not
+            trackers map to themselves.
+        """
+        unique_links = list(dict.fromkeys(links))
+        trackers = [link for link in unique_links if self.is_tracker(link)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            resolved = dict(zip(trackers, executor.map(self.resolve, trackers)))
+        return {link: resolved.get(link, link) for link in unique_links}
+
+    def canonicalize(self, links):
+        """
+        Canonicalizes a list of links, resolving tracker links first.
+
+        Args:
+            links: an iterable of links, possibly containing duplicates.
+
+        Returns:
+            a dict {link: canonical URL}, in order of first appearance of the links.
+        """
+        return {link: canonicalize_url(url) for link, url in self.resolve_all(links).items()}
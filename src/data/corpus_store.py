@@ -0,0 +1,206 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+def content_hash(raw_text):
+    """
+    Args:
+        raw_text: the body of a page, as a string.
+
+    Returns:
+        the hex SHA-256 digest of the utf-8 encoded body, the key of a document in the corpus store.
+    """
+    return hashlib.sha256(raw_text.encode('utf-8')).hexdigest()
+
+
+class CorpusStore:
+    """
+    An append-only, content-addressed store of the retrieved articles, replacing the pickled
+    `LinkParser` in `parser.jbl`.
+
+    Documents are stored once per content hash, with their content type, (zlib compressed) raw
+    body and parsed text; every canonical URL points at the document it led to. Each run appends
+    its new documents, and documents are read lazily, so nothing needs to be loaded at startup.
+    For column-wise reads, e.g. in feature building, the store can be exported to a Parquet file
+    that is read memory-mapped (requires `pyarrow`). A store can be shared between threads.
+    """
+
+    def __init__(self, path='../../data/processed/corpus.sqlite'):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS documents '
+            '(content_hash TEXT PRIMARY KEY, content_type TEXT, raw BLOB, text TEXT, added_at REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS urls '
+            '(url TEXT PRIMARY KEY, content_hash TEXT NOT NULL REFERENCES documents, added_at REAL NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS urls_content_hash ON urls (content_hash);'
+            'CREATE INDEX IF NOT EXISTS documents_added_at ON documents (added_at);')
+        self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def __contains__(self, url):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM urls WHERE url = ?', (url,)).fetchone() is not None
+
+    def add(self, url, content_type, raw_text, text=None, commit=True):
+        """
+        Appends a document, unless a document with the same content is already stored, and points `url` at it.
+
+        Args:
+            url: the canonical URL the document was retrieved from.
+            content_type: the content type of the document.
+            raw_text: the body of the document.
+            text (optional): the parsed text of the document.
+            commit (optional): whether to commit right away; pass False when adding many documents.
+
+        Returns:
+            the content hash of the document.
+        """
+        digest = content_hash(raw_text)
+        raw = zlib.compress(raw_text.encode('utf-8'))
+        with self._lock:
+            now = time.time()
+            self._connection.execute('INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?, ?)',
+                                     (digest, content_type, raw, text, now))
+            if text is not None:
+                self._connection.execute('UPDATE documents SET text = ? WHERE content_hash = ? AND text IS NULL',
+                                         (text, digest))
+            self._connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)', (url, digest, now))
+            if commit:
+                self._connection.commit()
+        return digest
+
+    def add_corpus(self, corpus, parsed=None):
+        """
+        Appends all documents of a `LinkParser` corpus in a single transaction.
+
+        Args:
+            corpus: a dict with structure {link: (content_type, raw_text)}, as returned by `retrieve_text`.
+            parsed (optional): a dict with structure {link: text}, as returned by `parse_text`.
+
+        Returns:
+            a dict with structure {link: content_hash}.
+        """
+        parsed = parsed if parsed is not None else {}
+        hashes = {}
+        with self._lock, self._connection:
+            for link, (content_type, raw_text) in corpus.items():
+                text = parsed.get(link)
+                if isinstance(text, tuple):
+                    # parse_text leaves non-HTML documents as they are; their body is their text.
+                    text = text[1]
+                hashes[link] = self.add(link, content_type, raw_text, text, commit=False)
+        return hashes
+
+    def get(self, url):
+        """
+        Returns:
+            a dict with the `url`, `content_hash`, `content_type`, `raw` body and `text` of the document
+            `url` points at, or `None` if `url` is not in the store.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT u.url, d.content_hash, d.content_type, d.raw, d.text FROM urls u '
+                'JOIN documents d ON d.content_hash = u.content_hash WHERE u.url = ?', (url,)).fetchone()
+        return self._row_to_document(row, ('url', 'content_hash', 'content_type', 'raw', 'text')) if row else None
+
+    def iter_documents(self, since=None, fields=('url', 'content_hash', 'text'), batch_size=256):
+        """
+        Lazily iterates over the stored documents, in the order they were added, fetching `batch_size` rows at a time.
+        A document that several URLs point at is yielded once, with the (alphabetically) first of its URLs.
+
+        Args:
+            since (optional): only yield the documents added after this timestamp, e.g. those of the latest run.
+            fields (optional): the fields to read, from 'url', 'content_hash', 'content_type', 'raw', 'text'
+                and 'added_at'; reading 'raw' decompresses every body, so leave it out where possible.
+            batch_size (optional): the number of rows fetched from the database at once.
+
+        Yields:
+            dicts with the requested fields.
+        """
+        columns = {'url': 'MIN(u.url)', 'content_hash': 'd.content_hash', 'content_type': 'd.content_type',
+                   'raw': 'd.raw', 'text': 'd.text', 'added_at': 'd.added_at'}
+        query = (f'SELECT {", ".join(columns[field] for field in fields)} FROM documents d '
+                 f'JOIN urls u ON u.content_hash = d.content_hash WHERE d.added_at > ? '
+                 f'GROUP BY d.content_hash ORDER BY d.added_at, d.content_hash')
+        with self._lock:
+            cursor = self._connection.execute(query, (since if since is not None else float('-inf'),))
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield self._row_to_document(row, fields)
+
+    @staticmethod
+    def _row_to_document(row, fields):
+        document = dict(zip(fields, row))
+        if document.get('raw') is not None:
+            document['raw'] = zlib.decompress(document['raw']).decode('utf-8')
+        return document
+
+    def export_parquet(self, path='../../data/processed/corpus.parquet', since=None, batch_size=10000):
+        """
+        Exports the url, content hash, content type, parsed text and time added of the stored documents to a
+        Parquet file, in row groups of `batch_size` documents, for memory-mapped column-wise reads with
+        `read_columns`. Requires `pyarrow`.
+
+        Returns:
+            the path of the Parquet file.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        fields = ('url', 'content_hash', 'content_type', 'text', 'added_at')
+        schema = pa.schema([('url', pa.string()), ('content_hash', pa.string()), ('content_type', pa.string()),
+                            ('text', pa.large_string()), ('added_at', pa.float64())])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with pq.ParquetWriter(path, schema) as writer:
+            batch = []
+            for document in self.iter_documents(since=since, fields=fields):
+                batch.append(document)
+                if len(batch) == batch_size:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        return path
+
+    def commit(self):
+        """
+        Commits the documents added with `commit=False`.
+        """
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def read_columns(path='../../data/processed/corpus.parquet', columns=('content_hash', 'text')):
+    """
+    Reads columns of an exported corpus memory-mapped, without loading the other columns. Requires `pyarrow`.
+
+    Args:
+        path (optional): the Parquet file written by `CorpusStore.export_parquet`.
+        columns (optional): the columns to read.
+
+    Returns:
+        a `pyarrow.Table` with the requested columns.
+    """
+    import pyarrow.parquet as pq
+
+    return pq.read_table(path, columns=list(columns), memory_map=True)
@@ -0,0 +1,91 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from src.data.fetch import Fetcher
+from src.data.metrics import METRICS
+
+# Status codes that indicate a temporary problem on the server side, worth retrying after a while.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class Crawler:
+    """
+    The retrieval engine of `LinkParser`: downloads many pages concurrently while staying polite
+    to every single site.
+
+    Pages are downloaded through a shared `Fetcher` (one pooled session) on a thread pool of
+    `max_workers` threads, which caps the global concurrency. Per domain, at most
+    `per_domain_limit` requests are in flight, and consecutive requests are started at least
+    `per_domain_delay` seconds apart. Timeouts, connection errors and temporary server errors
+    are retried up to `max_retries` times with exponential backoff.
+    """
+
+    def __init__(self, fetcher=None, max_workers=16, per_domain_limit=2, per_domain_delay=0.5,
+                 max_retries=3, backoff=1.0):
+        self.fetcher = fetcher if fetcher is not None else Fetcher(pool_size=max_workers)
+        self.max_workers = max_workers
+        self.per_domain_limit = per_domain_limit
+        self.per_domain_delay = per_domain_delay
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._domains = {}
+        self._lock = threading.Lock()
+
+    def _domain(self, url):
+        domain = urlsplit(url).netloc.lower()
+        with self._lock:
+            if domain not in self._domains:
+                # [semaphore limiting in-flight requests, earliest start time of the next request]
+                self._domains[domain] = [threading.BoundedSemaphore(self.per_domain_limit), 0.0]
+            return self._domains[domain]
+
+    def _wait_for_turn(self, domain_state):
+        with self._lock:
+            start = max(time.monotonic(), domain_state[1])
+            domain_state[1] = start + self.per_domain_delay
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def fetch(self, url):
+        """
+        Downloads a single page, respecting the politeness limits of its domain and retrying on failure.
+        A page the fetcher already downloaded (and kept) is taken over without a new request.
+
+        Args:
+            url: the URL to download.
+
+        Returns:
+            a `FetchResult` (whose `redirects` tracks the redirects that were followed), or `None` if
+            the URL could not be requested.
+        """
+        result = self.fetcher.take(url)
+        if result is not None:
+            METRICS.inc('crawler_pages_reused')
+            return result
+        domain_state = self._domain(url)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                METRICS.inc('crawler_retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            with domain_state[0]:
+                self._wait_for_turn(domain_state)
+                result = self.fetcher.fetch(url, keep=False)
+            if result is not None and result.status_code not in RETRY_STATUS_CODES:
+                break
+        return result
+
+    def crawl(self, urls):
+        """
+        Downloads a list of pages concurrently.
+
+        Args:
+            urls: the URLs to download.
+
+        Returns:
+            a list with a `FetchResult` (or `None`) per URL, in the order of `urls`.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.fetch, urls))
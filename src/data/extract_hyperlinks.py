@@ -1,96 +1,204 @@
 import email
+import email.policy
 import logging
 import base64
-import re
-from requests import get
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 from pathlib import Path
+from src.data.canonicalize import UrlCanonicalizer, canonicalize_url
+from src.data.extract_urls import UrlExtractor
+from src.data.metrics import METRICS
+from src.data.url_cache import UrlStatusCache
+from src.data.validate_links import LinkValidator
+
+logger = logging.getLogger(__name__)
 
 # see https://stackoverflow.com/questions/39373243/what-is-the-encoding-of-the-body-of-gmail-message-how-to-decode-it
 # TODO: Make sure solution handless mime and non-mime
 
 
+def decode_message(item, include_html=False):
+    """
+    :param item: A tuple (gmail_msg_id, raw_msg), with raw_msg a message retrieved from the gmail API in raw format.
+    :param include_html: Whether to also extract the text/html part of the message, for finding the links in it.
+
+    Decodes a single raw message from base64, reads it into an e-mail message using the email library with the
+    appropriate policy, and extracts its text: the (last) text/plain part that is not an attachment if the message is
+    multipart, or the whole payload otherwise. As per Todor Minakov's answer at
+    https://stackoverflow.com/questions/17874360/python-how-to-parse-the-body-from-a-raw-email-given-that-raw-email-does-not
+    With `include_html`, the (last) text/html part is appended to that. Then replaces the e-mail line endings by spaces.
+    A module level function, so it can run in a worker process.
+
+    :return decoded: A tuple (msg_id, parsed string), with parsed string None if the message has no text part.
+    """
+    msg_id, content = item
+    msg_str = base64.urlsafe_b64decode(content['raw'].encode('UTF8'))
+    b = email.message_from_bytes(msg_str, policy=email.policy.SMTPUTF8)
+    body = None
+    html_body = None
+    if b.is_multipart():
+        for part in b.walk():
+            ctype = part.get_content_type()
+            cdispo = str(part.get('Content-Disposition'))
+
+            # skip any text/plain (txt) attachments
+            if ctype == 'text/plain' and 'attachment' not in cdispo:
+                body = part.get_payload(decode=True)  # decode
+            elif include_html and ctype == 'text/html' and 'attachment' not in cdispo:
+                html_body = decode_part(part)
+    # not multipart - i.e. plain text, no attachments, keeping fingers crossed
+    else:
+        body = b.get_payload(decode=True)
+    texts = []
+    if body is not None:
+        texts.append(body.decode("utf-8"))
+    if html_body is not None:
+        texts.append(html_body)
+    if not texts:
+        return msg_id, None
+    return msg_id, ' '.join(texts).replace('\r\n', ' ')
+
+
+def decode_part(part):
+    """
+    :param part: A non-multipart e-mail message part.
+
+    Decodes the payload of a part in its declared charset, falling back to utf-8, replacing undecodable bytes.
+
+    :return text: The decoded payload.
+    """
+    payload = part.get_payload(decode=True) or b''
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+def decode_messages(items, include_html=False):
+    """
+    :param items: A list of (gmail_msg_id, raw_msg) tuples.
+    :param include_html: Whether to also extract the text/html part of the messages.
+
+    Decodes a chunk of messages in a worker process, see `decode_message`.
+
+    :return: A list of (msg_id, parsed string) tuples.
+    """
+    return [decode_message(item, include_html=include_html) for item in items]
+
+
 class InboxDelta:
 
-    def __init__(self, msg_dict):
+    def __init__(self, msg_dict, validator=None, processes=None, url_extractor=None, canonicalizer=None,
+                 run_pipeline=True, known_urls=()):
         self.retrieved = msg_dict
-        self.string_msgs = self.extract(self.retrieved)
-        self.hyperlinks = self.parse(self.string_msgs)
-
-    def extract(self, raw_msgs):
+        # Canonical URLs of the articles retrieved before, e.g. a `CorpusStore`; they are not validated again.
+        self.known_urls = known_urls
+        self.validator = validator if validator is not None else LinkValidator(cache=UrlStatusCache())
+        self.url_extractor = url_extractor if url_extractor is not None else UrlExtractor()
+        # Shares the validator's cache, so resolved tracker links are remembered between runs.
+        self.canonicalizer = canonicalizer if canonicalizer is not None else UrlCanonicalizer(cache=self.validator.cache)
+        self.canonical_links = {}
+        self.fetch_urls = {}
+        if run_pipeline:
+            # Includes the text/html parts, since many newsletters only link their articles from there.
+            self.string_msgs = self.extract(self.retrieved, processes=processes, include_html=True)
+            self.hyperlinks = self.parse(self.string_msgs)
+
+    def extract(self, raw_msgs, processes=None, include_html=False):
         """
         :param raw_msgs: A dictionary of raw e-mail messages retrieved from the gmail API, with structure {gmail_msg_id:
         raw_msg_bytestring}
+        :param processes: The number of worker processes to decode the messages with, or None to decode them in the
+        current process.
+        :param include_html: Whether to append the text/html part of each message to its text.
 
-        Takes a dict of raw messages, decodes them from base64 into utf-8, reads them into e-mail messages using the
-        email library with the appropriate policy, and parses them. Parsing involves walking through a multipart
-        structure and extracting the text if the message is multipart, or extracting the text if otherwise. As per
-        Todor Minakov's answer at https://stackoverflow.com/questions/17874360/python-how-to-parse-the-body-from-a-raw-email-given-that-raw-email-does-not
-        Then parses the e-mail line endings from the file and stores the resulting string in a dict with structure
-        {msg_id: parsed string}.
+        Decodes all raw messages into strings, see `decode_message`, and stores them in a dict.
 
         :return extract_store: A dict of email message strings with structure {msg_id: parsed string}.
         """
-        extract_store = {}
-        for msg_id, content in raw_msgs.items(): # TODO: Make sure this handles NoneType for msgs
-            msg_str = base64.urlsafe_b64decode(content['raw'].encode('UTF8'))
-            b = email.message_from_bytes(msg_str, policy=email.policy.SMTPUTF8)
-            body = ""
-            if b.is_multipart():
-                for part in b.walk():
-                    ctype = part.get_content_type()
-                    cdispo = str(part.get('Content-Disposition'))
-
-                    # skip any text/plain (txt) attachments
-                    if ctype == 'text/plain' and 'attachment' not in cdispo:
-                        body = part.get_payload(decode=True)  # decode
-                        extract_store[msg_id] = body
-                        continue
-            # not multipart - i.e. plain text, no attachments, keeping fingers crossed
-            else:
-                body = b.get_payload(decode=True)
-                extract_store[msg_id] = body
-        for key, val in extract_store.items():
-            val_parsed = re.sub('\r\n', ' ', val.decode("utf-8"))
-            extract_store[key] = val_parsed
-        return extract_store
+        with METRICS.timer(stage='extract'):
+            string_msgs = dict(self.iter_extract(raw_msgs, processes=processes, include_html=include_html))
+        METRICS.inc('messages_decoded', len(string_msgs))
+        return string_msgs
+
+    def iter_extract(self, raw_msgs, processes=None, chunksize=16, include_html=False, window=None):
+        """
+        :param raw_msgs: A dictionary of raw e-mail messages retrieved from the gmail API, with structure {gmail_msg_id:
+        raw_msg_bytestring}, or any iterable of (gmail_msg_id, raw_msg) tuples, e.g. a lazy scan of an archive.
+        :param processes: The number of worker processes to decode the messages with, or None to decode them in the
+        current process.
+        :param chunksize: The number of messages sent to a worker process at once.
+        :param include_html: Whether to append the text/html part of each message to its text.
+        :param window: The number of chunks submitted to the worker processes at a time; 2 per process by default.
+
+        Lazily decodes raw messages into strings, see `decode_message`, one message at a time, so that only the
+        messages in flight are held in memory. With worker processes, at most `window` chunks of `chunksize` messages
+        are read ahead of the consumer. Messages without a text part are skipped.
+
+        :return: A generator of (msg_id, parsed string) tuples, in the order of `raw_msgs`.
+        """
+        items = raw_msgs.items() if isinstance(raw_msgs, dict) else raw_msgs
+        decode = partial(decode_message, include_html=include_html)
+        # TODO: Make sure this handles NoneType for msgs
+        if processes is None or processes == 1:
+            decoded = map(decode, items)
+            yield from ((msg_id, text) for msg_id, text in decoded if text is not None)
+        else:
+            # Unlike `executor.map`, which reads all items up front, only submit a bounded window of chunks.
+            items = iter(items)
+            window = window or 2 * processes
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                pending = deque()
+                while True:
+                    while len(pending) < window:
+                        chunk = list(islice(items, chunksize))
+                        if not chunk:
+                            break
+                        pending.append(executor.submit(decode_messages, chunk, include_html=include_html))
+                    if not pending:
+                        break
+                    yield from ((msg_id, text) for msg_id, text in pending.popleft().result() if text is not None)
 
     def parse(self, string_msg_dict):
         """
         :param string_msg_dict: A dictionary of string e-mail messages, with structure {gmail_msg_id:
-        content_string}
-
-        Takes a dictionary of extracted e-mail messages that have been processed to strings, parses out a link starting
-         with 'https://', cleans the link according to a number of selection rules, and returns a list of hyperlinks.
-
-        :return msg_hyperlink_store: A list of hyperlinks extrated from e-mail messages, not including mails from
-        google or subscription related mails.
+        content_string}, or an iterable of (gmail_msg_id, content_string) tuples as yielded by `iter_extract`.
+
+        Takes a dictionary of extracted e-mail messages that have been processed to strings (plain text and/or HTML),
+        extracts the http(s) links from them with `self.url_extractor`, which also applies the exclusion rules,
+        resolves click-tracking redirects with `self.canonicalizer` and maps the links to canonical URLs (stripping
+        tracking parameters) to deduplicate them, and returns a list of the canonical URLs that are valid. The mapping
+        from the links as found to their canonical URL is kept in `self.canonical_links`. Canonical URLs are only keys:
+        every page is validated and retrieved with the (resolved) link it was first found as, kept in
+        `self.fetch_urls` as {canonical URL: URL to request}. Links to articles in `self.known_urls` are skipped
+        before validation.
+
+        :return msg_hyperlink_store: A list of canonical hyperlinks extrated from e-mail messages, not including mails
+        from google or subscription related mails, that return status 200. Links are validated concurrently by
+        `self.validator` and returned deduplicated, in order of first appearance.
         """
-        parsed_list = []
-        msg_hyperlink_store = []
-        for key, msg_string in string_msg_dict.items():
-            msg_word_list = msg_string.split(" ")
-            hyperlink_list = [word for word in msg_word_list if 'http' in word]
-            for link in hyperlink_list:
-                if re.match('.*\(http.*://', link):
-                    link = link.split(sep='(')[1]
-                    link = link.rsplit(sep=')')[0]
-                parsed_list.append(link)
-        checklist = []
-        for link in parsed_list:
-            if (link not in checklist) and \
-                ('accounts.google.com' not in link) and \
-                ('subscr' not in link) and \
-                ('aiohttp' not in link) and \
-                ('http' in link) and \
-                ('://' in link): # TODO: Into config for rules related to the various newsletter configurations
-                try:
-                    code = get(link).status_code
-                except:
-                    code = 201
-                if code == 200:
-                    msg_hyperlink_store.append(link) # TODO: Consider adding a header based check for valid url using requests (but perhaps not given higher amount of website calls)
-                    checklist.append(link)
-        print("Hyperlinks extracted")
+        items = string_msg_dict.items() if isinstance(string_msg_dict, dict) else string_msg_dict
+        with METRICS.timer(stage='parse'):
+            found = dict.fromkeys(link for key, msg_string in items
+                                  for link in self.url_extractor.extract(msg_string))
+            resolved = self.canonicalizer.resolve_all(found)
+            self.canonical_links = {link: canonicalize_url(url) for link, url in resolved.items()}
+            self.fetch_urls = {}
+            for link, canonical in self.canonical_links.items():
+                self.fetch_urls.setdefault(canonical, resolved[link])
+            # Resolved trackers may lead to excluded pages too, e.g. an unsubscribe page.
+            candidates = [canonical for canonical in self.fetch_urls
+                          if not self.url_extractor.is_excluded(canonical) and canonical not in self.known_urls]
+            valid = set(self.validator.validate(self.fetch_urls[canonical] for canonical in candidates))
+            msg_hyperlink_store = [canonical for canonical in candidates if self.fetch_urls[canonical] in valid]
+        METRICS.inc('links_found', len(found))
+        METRICS.inc('links_valid', len(msg_hyperlink_store))
+        cache_stats = self.validator.cache.stats() if self.validator.cache is not None else None
+        logger.info('hyperlinks extracted', extra={'links': len(found), 'canonical_links': len(candidates),
+                                                   'valid_links': len(msg_hyperlink_store),
+                                                   'url_status_cache': cache_stats})
         return msg_hyperlink_store
 
 
@@ -0,0 +1,70 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from string import punctuation
+
+from bs4 import BeautifulSoup
+from src.data.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# The HTML parser used by BeautifulSoup; lxml is an order of magnitude faster than html5lib.
+DEFAULT_PARSER = 'lxml'
+# Lines with a larger share of punctuation characters are considered markup or code, not text.
+MAX_PUNCTUATION_RATIO = .1 # TODO: Check if this setting is appropriate, make data-driven
+# Translation table deleting all punctuation, so a line's punctuation count is the length it loses.
+_DELETE_PUNCTUATION = str.maketrans('', '', punctuation)
+
+
+def extract_text(html, parser=DEFAULT_PARSER):
+    """
+    Extracts the running text from an HTML document: prettifies the document so every tag and
+    text node is on its own line, and keeps the lines with a low share of punctuation characters.
+
+    Args:
+        html: the HTML document as a string.
+        parser (optional): the name of the parser BeautifulSoup should use.
+
+    Returns:
+        the kept lines, concatenated; an empty string if the document has no content.
+    """
+    soup = BeautifulSoup(html, parser)
+    kept_lines = []
+    for line in soup.prettify().split("\n"):
+        #if len(line) > 200: # TODO: Check is this setting is appropriate, make data-driven
+        punctuation_counts = len(line) - len(line.translate(_DELETE_PUNCTUATION))
+        if punctuation_counts / (len(line)+.0000000000000000001) < MAX_PUNCTUATION_RATIO:
+            kept_lines.append(line)
+    return ''.join(kept_lines)
+
+
+def parse_corpus(corpus, processes=None, parser=DEFAULT_PARSER, chunksize=8):
+    """
+    Replaces the HTML documents in a corpus by their extracted text, in place.
+
+    Args:
+        corpus: a dict with structure {link: (content_type, text)}.
+        processes (optional): the number of worker processes to parse documents with; `None` or 1
+            parses them in the current process.
+        parser (optional): the name of the parser BeautifulSoup should use.
+        chunksize (optional): the number of documents sent to a worker process at once.
+
+    Returns:
+        the corpus, with structure {link: text} for the HTML documents. Other documents are left as they are.
+    """
+    links = [link for link, text_tpl in corpus.items() if 'html' in text_tpl[0]]
+    documents = [corpus[link][1] for link in links]
+    parsers = [parser] * len(documents)
+    with METRICS.timer(stage='parse_text'):
+        if processes is None or processes == 1:
+            texts = list(map(extract_text, documents, parsers))
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                texts = list(executor.map(extract_text, documents, parsers, chunksize=chunksize))
+    METRICS.inc('documents_parsed', len(texts))
+    for link, text in zip(links, texts):
+        corpus[link] = text
+    for link in links:
+        if not corpus[link]:
+            METRICS.inc('documents_empty')
+            logger.warning('nothing mined', extra={'link': link})
+    return corpus
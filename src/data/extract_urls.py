@@ -0,0 +1,48 @@
+import html
+import re
+
+# Substrings of links that are never worth retrieving: google account pages and (un)subscribe links.
+# TODO: Into config for rules related to the various newsletter configurations
+DEFAULT_EXCLUDE_RULES = ('accounts.google.com', 'subscr', 'aiohttp')
+
+# Matches http(s) URLs in plain text as well as in HTML attributes such as `href`. A URL ends at whitespace, quotes,
+# brackets or angle brackets, and never ends in sentence punctuation. Balanced parentheses are part of the URL, as in
+# https://en.wikipedia.org/wiki/Python_(language), but an unbalanced closing one is not, as in `(see https://...)`.
+_URL_CHAR = r'''[^\s<>"'()\[\]{}]'''
+_URL_END_CHAR = r'''[^\s<>"'()\[\]{}.,;:!?]'''
+_URL_PARENTHESES = rf'\({_URL_CHAR}*\)'
+URL_PATTERN = re.compile(rf'https?://(?:{_URL_CHAR}|{_URL_PARENTHESES})*(?:{_URL_END_CHAR}|{_URL_PARENTHESES})',
+                         re.IGNORECASE)
+
+
+class UrlExtractor:
+    """
+    Extracts hyperlinks from plain-text and HTML message bodies in a single pass of one compiled
+    regular expression, and drops the links matching any of the `exclude_rules` substrings. The
+    rules are compiled once, into a single pattern.
+    """
+
+    def __init__(self, exclude_rules=DEFAULT_EXCLUDE_RULES):
+        self.exclude_rules = tuple(exclude_rules)
+        self._exclude = re.compile('|'.join(map(re.escape, self.exclude_rules))) if self.exclude_rules else None
+
+    def is_excluded(self, url):
+        return self._exclude is not None and self._exclude.search(url) is not None
+
+    def extract(self, text):
+        """
+        :param text: A message body, plain text or HTML.
+
+        Finds all http(s) URLs in the text, including those in `href` attributes (with HTML entities such as `&amp;`
+        unescaped), and applies the exclusion rules.
+
+        :return urls: A list of the URLs found, deduplicated and in order of first appearance.
+        """
+        urls = {}
+        for match in URL_PATTERN.finditer(text):
+            url = match.group()
+            if '&' in url:
+                url = html.unescape(url)
+            if url not in urls and not self.is_excluded(url):
+                urls[url] = None
+        return list(urls)
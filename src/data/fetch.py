@@ -0,0 +1,279 @@
+import codecs
+import re
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from src.data.metrics import METRICS
+
+# The content types whose bodies are downloaded; anything else (PDFs, video, ...) is never parsed anyway.
+TEXT_CONTENT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+# Matches `charset=...` in a Content-Type header, and in <meta> tags or an XML declaration at the start of a page.
+CHARSET_PATTERN = re.compile(rb'''charset\s*=\s*["']?([a-zA-Z0-9_.:-]+)''', re.IGNORECASE)
+XML_ENCODING_PATTERN = re.compile(rb'''^<\?xml[^>]*encoding\s*=\s*["']([a-zA-Z0-9_.:-]+)''', re.IGNORECASE)
+
+# The parts of an HTTP response the pipeline needs downstream, detached from the `requests` response object.
+# `redirects` lists the URLs of the redirect responses that were followed to get to `final_url`. `text` is
+# `None` when the body was not downloaded, because of its content type or size, or could not be decoded.
+FetchResult = namedtuple('FetchResult', ['url', 'final_url', 'status_code', 'headers', 'encoding', 'text',
+                                         'redirects'], defaults=((),))
+
+
+def make_session(pool_size=16):
+    """
+    Creates a `requests` session whose connection pools are large enough to be shared by
+    `pool_size` worker threads, so connections to the same host are reused between requests.
+
+    Args:
+        pool_size (optional): the number of connections kept open per host.
+
+    Returns:
+        a `requests.Session` object.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def text_encoding(name):
+    """
+    Args:
+        name: the name of an encoding, e.g. from a charset declaration.
+
+    Returns:
+        the normalized name of the encoding, or `None` if it is unknown or not a text encoding (like
+        'base64' or 'rot13'). ASCII is widened to UTF-8, its superset, since an ASCII guess is based
+        on the start of a page only.
+    """
+    try:
+        info = codecs.lookup(name)
+    except LookupError:
+        return None
+    if not getattr(info, '_is_text_encoding', True):
+        return None
+    return 'utf-8' if info.name == 'ascii' else info.name
+
+
+def detect_encoding(content_type, head):
+    """
+    Determines the character encoding of a page, from the charset in its Content-Type header, a
+    charset declared at the start of the page itself, or by sniffing its first bytes, in that order.
+
+    Args:
+        content_type: the value of the Content-Type header.
+        head: the first bytes of the body.
+
+    Returns:
+        the normalized name of the encoding, e.g. 'utf-8'.
+    """
+    candidates = []
+    match = CHARSET_PATTERN.search(content_type.encode('latin-1', 'ignore'))
+    if match:
+        candidates.append(match.group(1))
+    match = XML_ENCODING_PATTERN.search(head) or CHARSET_PATTERN.search(head[:2048])
+    if match:
+        candidates.append(match.group(1))
+    for candidate in candidates:
+        encoding = text_encoding(candidate.decode('ascii', 'ignore'))
+        if encoding is not None:
+            return encoding
+    try:
+        from charset_normalizer import from_bytes
+        best = from_bytes(head).best()
+        if best is not None:
+            return text_encoding(best.encoding) or 'utf-8'
+    except ImportError:
+        pass
+    return 'utf-8'
+
+
+class _BodyDecoder:
+    """
+    Decodes a body chunk by chunk while it is downloaded, in the encoding `detect_encoding` finds for
+    the first chunk. A body that can't be decoded stops being decoded instead of raising.
+    """
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+        self.encoding = None
+        self._decoder = None
+        self._parts = []
+
+    def feed(self, chunk):
+        if self._decoder is None:
+            self.encoding = detect_encoding(self.content_type, chunk)
+            self._decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        self._decode(chunk)
+
+    def finish(self):
+        """
+        Returns:
+            the decoded text, or `None` if the body could not be decoded.
+        """
+        if self._decoder is None:
+            self.encoding = detect_encoding(self.content_type, b'')
+            return ''
+        self._decode(b'', final=True)
+        return ''.join(self._parts) if self._parts is not None else None
+
+    def _decode(self, chunk, final=False):
+        if self._parts is None:
+            return
+        try:
+            self._parts.append(self._decoder.decode(chunk, final=final))
+        except (UnicodeError, TypeError, ValueError):
+            # A broken page shouldn't take the other pages of the run down with it.
+            self._parts = None
+
+
+class Fetcher:
+    """
+    The shared fetch layer of the link stages. Downloads pages over one pooled session and keeps
+    the successful (status 200) results, so a page that was downloaded to validate a link is
+    handed to `LinkParser.retrieve_text` instead of being downloaded a second time.
+
+    If an `HttpCache` is passed as `cache`, pages it holds are revalidated with a conditional GET
+    and served from disk when the server answers 304 Not Modified.
+
+    Bodies are streamed: only responses with one of the `content_types` are read, and reading
+    stops at `max_bytes`, so memory use stays bounded. Bodies are decoded incrementally in the
+    encoding found by `detect_encoding`.
+    """
+
+    def __init__(self, session=None, timeout=10, pool_size=16, cache=None, max_bytes=5 * 1024 * 1024,
+                 content_types=TEXT_CONTENT_TYPES, chunk_size=64 * 1024):
+        self.session = session if session is not None else make_session(pool_size)
+        self.timeout = timeout
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.content_types = content_types
+        self.chunk_size = chunk_size
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, url, keep=True):
+        """
+        Downloads `url`, following redirects, and keeps the result if it has status 200. The body is only
+        downloaded for accepted content types and sizes; otherwise the result's `text` is `None`.
+
+        Args:
+            url: the URL to download.
+            keep (optional): whether to keep a successful result for a later `get` or `take`.
+
+        Returns:
+            a `FetchResult`, or `None` if the URL could not be requested.
+        """
+        headers = self.cache.conditional_headers(url) if self.cache is not None else {}
+        result = self._request(url, keep, headers)
+        if headers and result is not None and result.status_code == 304:
+            # The cached page went missing (e.g. evicted) after its validators were sent; download it again.
+            METRICS.inc('http_cache_misses')
+            result = self._request(url, keep, {})
+        return result
+
+    def _request(self, url, keep, headers):
+        start = time.perf_counter()
+        try:
+            with self.session.get(url, allow_redirects=True, timeout=self.timeout, headers=headers,
+                                  stream=True) as response:
+                METRICS.inc('http_requests', method='GET', status=response.status_code)
+                redirects = tuple(r.url for r in response.history)
+                cached = self.cache.get(url) if headers and response.status_code == 304 else None
+                if cached is not None:
+                    METRICS.inc('http_cache_hits')
+                    encoding = cached['encoding']
+                    try:
+                        text = cached['content'].decode(text_encoding(encoding or 'utf-8') or 'utf-8',
+                                                        errors='replace')
+                    except (UnicodeError, TypeError, ValueError):
+                        text = None
+                    return self._keep(keep, FetchResult(url, cached['final_url'], 200,
+                                                        CaseInsensitiveDict(cached['headers']), encoding,
+                                                        text, redirects))
+                encoding, text, content = None, None, None
+                if response.status_code == 200:
+                    encoding, text, content = self._read_body(response)
+        except (requests.RequestException, ValueError):
+            METRICS.inc('http_requests', method='GET', status='error')
+            return None
+        finally:
+            METRICS.observe('http_request_seconds', time.perf_counter() - start, method='GET')
+        result = FetchResult(url, response.url, response.status_code, CaseInsensitiveDict(response.headers),
+                             encoding, text, redirects)
+        if self.cache is not None and content is not None:
+            self.cache.put(url, response.url, response.headers, encoding, content)
+        return self._keep(keep, result)
+
+    def _read_body(self, response):
+        """
+        Streams the body of a response, provided its content type is accepted and it is not larger than
+        `self.max_bytes`, decoding it incrementally.
+
+        Returns:
+            a tuple (encoding, text, content), or (None, None, None) if the body was skipped. The raw
+            `content` is only collected (for the HTTP cache) if there is a cache. If the body can't be
+            decoded, `text` and `content` are `None`.
+        """
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip().lower() not in self.content_types:
+            METRICS.inc('http_bodies_skipped', reason='content_type')
+            return None, None, None
+        content_length = response.headers.get('Content-Length', '')
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            METRICS.inc('http_bodies_skipped', reason='size')
+            return None, None, None
+
+        chunks, size, decoder = [], 0, _BodyDecoder(content_type)
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            size += len(chunk)
+            if size > self.max_bytes:
+                METRICS.inc('http_bytes_downloaded', size)
+                METRICS.inc('http_bodies_skipped', reason='size')
+                return None, None, None
+            if self.cache is not None:
+                chunks.append(chunk)
+            decoder.feed(chunk)
+        METRICS.inc('http_bytes_downloaded', size)
+        text = decoder.finish()
+        if text is None:
+            METRICS.inc('http_bodies_skipped', reason='encoding')
+            return decoder.encoding, None, None
+        return decoder.encoding, text, (b''.join(chunks) if self.cache is not None else None)
+
+    def _keep(self, keep, result):
+        if keep and result.status_code == 200:
+            with self._lock:
+                self._results[result.url] = result
+        return result
+
+    def take(self, url):
+        """
+        Hands out the kept result for `url` without touching the network. The kept result is released,
+        since every page is only consumed once.
+
+        Args:
+            url: the URL to look up.
+
+        Returns:
+            a `FetchResult`, or `None` if `url` was not fetched (successfully) before.
+        """
+        with self._lock:
+            return self._results.pop(url, None)
+
+    def get(self, url):
+        """
+        Hands out the kept result for `url`, downloading it only if it was not fetched before.
+
+        Args:
+            url: the URL to retrieve.
+
+        Returns:
+            a `FetchResult`, or `None` if the URL could not be requested.
+        """
+        result = self.take(url)
+        return result if result is not None else self.fetch(url, keep=False)
@@ -6,28 +6,91 @@ from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 import pickle
 import os
+import time
+from itertools import islice
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient import errors
-from google.cloud import storage    
+from src.data.metrics import METRICS
+from src.data.storage import make_backend
 load_dotenv(find_dotenv())
 
+logger = logging.getLogger(__name__)
+
+# Error reasons GMail uses (next to HTTP 429) to signal that a request should be retried later.
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+# The maximum number of message ids GMail accepts in a single `messages().batchModify` call.
+BATCH_MODIFY_LIMIT = 1000
+
+
+def is_rate_limited(error):
+    """
+    Checks whether a GMail API error is a rate limit response that is worth retrying.
+
+    Args:
+        error: an exception raised by (or passed to the callback of) a GMail API request.
+
+    Returns:
+        True if the error is a 429, or a 403 with one of the rate limit reasons.
+    """
+    if not isinstance(error, errors.HttpError):
+        return False
+    status = getattr(error.resp, 'status', None)
+    if status == 429:
+        return True
+    if status == 403:
+        content = error.content.decode('utf-8', 'ignore') if isinstance(error.content, bytes) else str(error.content)
+        return any(reason in content for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def is_not_found(error):
+    """
+    Checks whether a GMail API error is a 404, e.g. for a message that was deleted since it was listed.
+    """
+    return isinstance(error, errors.HttpError) and getattr(error.resp, 'status', None) == 404
+
+
+def chunked(iterable, size):
+    """
+    Lazily splits an iterable into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class GMailGetter:  
-    def __init__(self, credentials=None, run_pipeline=True):
-        self.service = self.initialize_login(credentials)
+    def __init__(self, credentials=None, run_pipeline=True, incremental=False,
+                 checkpoint_file='../../data/interim/gmail_checkpoint.json', service=None):
+        # A ready `service` object (e.g. a stand-in for benchmarks) skips the login.
+        self.service = service if service is not None else self.initialize_login(credentials)
+        self.fetch_errors = {}
+        self.write_errors = {}
+        self.checkpoint_file = checkpoint_file
+        self.latest_history_id = None
         if run_pipeline:
-            self.unread_messages = self.get_unread_messages()
-            if self.unread_messages is not None:
-                gcp_metadata = {
-                    'credentials_file': os.environ['GCP_CREDENTIALS_FILE'],
-                    'bucket_name': os.environ['GCP_BUCKET_NAME'],
-                    'bucket_path': os.environ['GCP_BUCKET_PATH'] 
-                }
-                self.saved_to_disk, self.retrieved_delta = self.persist_to_storage(self.unread_messages, **gcp_metadata)
-                print('Persisted to storage:', self.saved_to_disk, '\n')
-                self.marked_as_read = self.mark_as_read(self.unread_messages)
-                print('Marked as read:', self.marked_as_read, '\n')
+            # A lazy generator: messages are downloaded batch by batch while later pages are still being listed.
+            if incremental:
+                self.unread_messages = self.get_new_messages()
+            else:
+                self.unread_messages = self.get_unread_messages()
+            # Without a configured bucket, messages are stored in the local archive.
+            gcp_metadata = {
+                'credentials_file': os.environ.get('GCP_CREDENTIALS_FILE'),
+                'bucket_name': os.environ.get('GCP_BUCKET_NAME'),
+                'bucket_path': os.environ.get('GCP_BUCKET_PATH') 
+            }
+            self.saved_to_disk, self.retrieved_delta = self.persist_to_storage(self.unread_messages, **gcp_metadata)
+            if self.retrieved_delta:
+                self.marked_as_read = self.mark_as_read(list(self.retrieved_delta))
+            if incremental and not self.fetch_errors and not self.write_errors:
+                # Only move the checkpoint forward when every new message that still exists made it to storage.
+                self.save_checkpoint(self.latest_history_id)
 
     def initialize_login(self, credentials):
         """
@@ -69,109 +132,308 @@ class GMailGetter:
             service = build('gmail', 'v1', credentials=credentials)
             return service
 
-    def get_unread_messages(self):
+    def get_unread_messages(self, page_size=100, max_results=None):
         """
-        Retrieves all unread messages from the connected GMail account.
+        Lazily retrieves all unread messages from the connected GMail account, walking through
+        every page of results by following `nextPageToken`.
 
-        Returns:
-            A collection of GMail messages (actually threads).
+        Args:
+            page_size (optional): the number of messages requested per page (GMail allows up to 500).
+            max_results (optional): stop after this many messages; `None` retrieves all of them.
+
+        Yields:
+            GMail messages (dicts with `id` and `threadId`), one at a time as pages arrive.
         """
         service = self.service
-        results = service.users().messages().list(userId='me', labelIds=['INBOX', 'UNREAD']).execute()
-        messages = results.get('messages', [])
+        page_token = None
+        found = 0
+        while max_results is None or found < max_results:
+            request_size = page_size if max_results is None else min(page_size, max_results - found)
+            results = service.users().messages().list(userId='me', labelIds=['INBOX', 'UNREAD'],
+                                                      maxResults=request_size, pageToken=page_token).execute()
+            for message in results.get('messages', []):
+                yield message
+                found += 1
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        METRICS.inc('gmail_messages_listed', found)
+        logger.info('found unread messages', extra={'messages': found})
+
+    def load_checkpoint(self):
+        """
+        Reads the `historyId` of the last completed incremental sync from `self.checkpoint_file`.
 
-        if not messages:
-            print('No unread threads found.')
+        Returns:
+            The stored history id, or `None` if there is no (readable) checkpoint yet.
+        """
+        try:
+            with open(self.checkpoint_file) as file:
+                return json.load(file).get('historyId')
+        except (OSError, ValueError):
             return None
-        else:
-            print('Found unread messages:', messages, '\n')
-            return messages
 
-    def mark_as_read(self, messages):
+    def save_checkpoint(self, history_id):
         """
-        Marks each in a collection of messages (actually threads) as READ in the 
-        connected GMail account.
-        
+        Stores `history_id` in `self.checkpoint_file` as the starting point of the next incremental sync.
+        """
+        if history_id is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint_file)), exist_ok=True)
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as file:
+            json.dump({'historyId': history_id}, file)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def get_new_messages(self, page_size=100):
+        """
+        Lazily retrieves the messages added to the inbox since the last completed sync, using the
+        GMail `history().list` deltas since the `historyId` in the local checkpoint. This makes a run
+        cost O(new mail) instead of O(inbox), and also picks up mails a human has already read.
+        Falls back to a full scan of unread messages when there is no checkpoint yet, or when GMail
+        no longer has history for it (a 404, typically after about a week).
+
+        The history id to checkpoint once the messages are persisted is stored in `self.latest_history_id`.
+
         Args:
-            messages: collection of GMail API messages objects.
+            page_size (optional): the number of history records requested per page.
+
+        Yields:
+            GMail messages (dicts with `id` and `threadId`), one at a time as pages arrive.
+        """
+        service = self.service
+        # Take the mailbox position before listing, so mail arriving during this run is seen by the next one.
+        self.latest_history_id = service.users().getProfile(userId='me').execute()['historyId']
+        start_history_id = self.load_checkpoint()
+
+        seen = set()
+        if start_history_id is not None:
+            try:
+                for message in self._list_history(start_history_id, page_size):
+                    if message['id'] not in seen:
+                        seen.add(message['id'])
+                        yield message
+                METRICS.inc('gmail_messages_listed', len(seen))
+                logger.info('found new messages since last sync', extra={'messages': len(seen)})
+                return
+            except errors.HttpError as error:
+                if not is_not_found(error):
+                    raise
+                logger.warning('checkpoint has expired, falling back to a full scan',
+                               extra={'history_id': start_history_id})
+
+        for message in self.get_unread_messages(page_size=page_size):
+            if message['id'] not in seen:
+                seen.add(message['id'])
+                yield message
+
+    def _list_history(self, start_history_id, page_size):
+        """
+        Walks through every page of `history().list` records of messages added to the inbox since
+        `start_history_id`.
+
+        Yields:
+            the message of every `messagesAdded` entry, possibly more than once.
+        """
+        page_token = None
+        while True:
+            results = self.service.users().history().list(userId='me', startHistoryId=start_history_id,
+                                                          historyTypes=['messageAdded'], labelId='INBOX',
+                                                          maxResults=page_size, pageToken=page_token).execute()
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    yield added['message']
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+
+    def mark_as_read(self, messages, chunk_size=BATCH_MODIFY_LIMIT, max_retries=5, backoff=1.0):
+        """
+        Marks a collection of messages as READ in the connected GMail account, using a single
+        `messages().batchModify` call per `chunk_size` ids (GMail accepts at most 1000 per call).
+        Pass only the messages that fully went through the pipeline to leave the others unread.
+        Rate limited calls are retried with exponential backoff.
+
+        Args:
+            messages: collection of GMail API messages objects, or plain message ids.
+            chunk_size (optional): the number of ids per batchModify call.
+            max_retries (optional): how often a rate limited call is retried before giving up.
+            backoff (optional): the initial wait in seconds between retries, doubled on each retry.
 
         Returns:
-            processed_messages (collection of GMail API messages objects)
+            processed_messages: a list of dicts {'id': msg_id, 'marked': bool, 'error': str or None},
+            one per message, in the order of `messages`.
         """
         service = self.service
-        msg_labels = {'removeLabelIds': ['UNREAD'], 'addLabelIds': []}
+        msg_ids = [message if isinstance(message, str) else message['id'] for message in messages]
 
         processed_messages = []
-        for thread in messages:
-            try:
-                thread = service.users().threads().modify(userId='me', id=thread['id'],
-                                              body=msg_labels).execute()
+        for chunk in chunked(msg_ids, chunk_size):
+            msg_labels = {'ids': chunk, 'removeLabelIds': ['UNREAD'], 'addLabelIds': []}
+            attempt = 0
+            while True:
+                try:
+                    with METRICS.timer('gmail_request_seconds', call='batchModify'):
+                        service.users().messages().batchModify(userId='me', body=msg_labels).execute()
+                    error = None
+                except errors.HttpError as http_error:
+                    if is_rate_limited(http_error) and attempt < max_retries:
+                        METRICS.inc('gmail_rate_limited_retries')
+                        time.sleep(backoff * 2 ** attempt)
+                        attempt += 1
+                        continue
+                    logger.error('marking messages as read failed', extra={'messages': len(chunk),
+                                                                           'error': str(http_error)})
+                    error = str(http_error)
+                break
+            METRICS.inc('gmail_messages_marked_read' if error is None else 'gmail_mark_read_failures', len(chunk))
+            processed_messages.extend({'id': msg_id, 'marked': error is None, 'error': error}
+                                      for msg_id in chunk)
+
+        logger.info('marked messages as read', extra={'messages': sum(result['marked'] for result in processed_messages)})
+        return processed_messages
+
+    def fetch_messages(self, messages, batch_size=50, max_retries=5, backoff=1.0):
+        """
+        Downloads the raw content of a collection of messages, grouping the `messages().get` calls
+        into GMail batch HTTP requests of `batch_size` requests each (GMail advises at most 50).
+        Requests that fail on a rate limit are retried with exponential backoff. Messages that no longer
+        exist (a 404, e.g. deleted spam that is still in the history) are skipped. Any other failure is
+        recorded in `self.fetch_errors` as {msg_id: error} and does not stop the remaining messages.
 
-                thread_id = thread['id']
-                label_ids = thread['messages'][0]['labelIds']
+        Args:
+            messages: collection of GMail API messages objects (dicts with at least an `id`).
+            batch_size (optional): the number of message gets per batch request.
+            max_retries (optional): how often rate limited requests are retried before giving up.
+            backoff (optional): the initial wait in seconds between retries, doubled on each retry.
 
-                # TODO: convert print statments to proper logging
-                print(f'Thread ID: {thread_id} - With Label IDs {label_ids}')
-                processed_messages.append(thread)
+        Yields:
+            raw GMail API message objects, in the order of `messages` within each batch.
+        """
+        for chunk in chunked((message['id'] for message in messages), batch_size):
+            yield from self._fetch_batch(chunk, max_retries, backoff)
 
+    def _fetch_batch(self, msg_ids, max_retries, backoff):
+        attempt = 0
+        while msg_ids:
+            try:
+                results, failed = self._execute_batch(msg_ids)
             except errors.HttpError as error:
-                print(f'An error occurred: {error}')
+                # The batch request as a whole failed; treat it as a failure of every message in it.
+                results, failed = {}, {msg_id: error for msg_id in msg_ids}
+
+            METRICS.inc('gmail_messages_fetched', len(results))
+            for msg_id in msg_ids:
+                if msg_id in results:
+                    yield results[msg_id]
+
+            msg_ids = self._record_failures(failed, retry=attempt < max_retries)
+            if not msg_ids:
+                return
+            METRICS.inc('gmail_rate_limited_retries', len(msg_ids))
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+    def _execute_batch(self, msg_ids):
+        """
+        Sends a single batch request with a `messages().get` for every id in `msg_ids`.
 
-        return processed_messages
+        Returns:
+            a tuple (results, failed) of dicts {msg_id: raw message} and {msg_id: error}.
+        """
+        service = self.service
+        results = {}
+        failed = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            else:
+                failed[request_id] = exception
+
+        batch = service.new_batch_http_request(callback=callback)
+        for msg_id in msg_ids:
+            batch.add(service.users().messages().get(userId='me', id=msg_id, format='raw'), request_id=msg_id)
+        with METRICS.timer('gmail_request_seconds', call='batch_get'):
+            batch.execute()
+        return results, failed
+
+    def _record_failures(self, failed, retry):
+        """
+        Sorts out the failed gets of a batch: rate limited ones are retried if `retry` is set, messages
+        that no longer exist are skipped, and any other failure is recorded in `self.fetch_errors`.
+
+        Args:
+            failed: a dict {msg_id: error}.
+            retry: whether rate limited gets may still be retried.
+
+        Returns:
+            the ids of the messages to retry.
+        """
+        retry_ids = []
+        for msg_id, error in failed.items():
+            if retry and is_rate_limited(error):
+                retry_ids.append(msg_id)
+            elif is_not_found(error):
+                # Deleted since it was listed: there is nothing left to fetch, now or in a later run.
+                logger.warning('message no longer exists', extra={'msg_id': msg_id})
+                METRICS.inc('gmail_messages_gone')
+            else:
+                logger.error('fetching message failed', extra={'msg_id': msg_id, 'error': str(error)})
+                METRICS.inc('gmail_fetch_failures')
+                self.fetch_errors[msg_id] = error
+        return retry_ids
 
     def persist_to_storage(self, messages, local_path='../../data/raw',
-                            credentials_file=None, bucket_name=None, bucket_path=None):
+                            credentials_file=None, bucket_name=None, bucket_path=None, batch_size=50,
+                            backend=None):
         """
-        Persists a collection of messages to storage as JSON text files, optionally to GCP 
-        object storage or to a local path. 
-        Pass the arguments `credentials_file`, `bucket_name` and `bucket_path` to store 
-        to GCP; do not pass them to store to a local path.
+        Persists a collection of messages to storage, to GCP object storage as JSON text files
+        or to a `MessageArchive` at a local path, see `src.data.storage`. 
+        Pass `bucket_name` (and `bucket_path`, and `credentials_file` unless a local emulator is
+        configured with `STORAGE_EMULATOR_HOST`) to store to GCP; do not pass them to store to a local path.
+        Messages are written while later batches are still being downloaded. A message that could not be
+        written is recorded in `self.write_errors` as {msg_id: error}, and left out of the returned messages so it
+        is not marked as read.
         
         Args:
             messages: collection of GMail API messages objects.
-            local_path (optional): a local path to save the files to.
+            local_path (optional): the directory of the local message archive.
             **gcp_metadata: a dictionary object with required GCP metadata.
+            batch_size (optional): the number of messages downloaded per GMail batch request.
+            backend (optional): a `StorageBackend` to use instead of the one chosen by the arguments above.
 
         Returns:
-            file_names: a list of processed filenames or GCP object names.
+            manifest: a list of dicts with the `id`, `location` and `bytes` of every written message.
+            message_store: a dict {msg_id: raw message} of the downloaded messages that were written.
         """
-        service = self.service
+        if backend is None:
+            backend = make_backend(local_path, credentials_file, bucket_name, bucket_path)
+        logger.info('persisting messages', extra={'backend': type(backend).__name__})
 
         message_store = {}
-        if credentials_file == bucket_name == bucket_path == None:
-            print(f"Persisting to local storage at: {local_path}")
-            file_names = []
-            for message in messages:
-
-                # TODO: msg['payload']['headers'][ITEREER if name=Received]['value'] om de afzender op te nemen in filename
-                msg = service.users().messages().get(userId='me', id=message['id'], format='raw').execute()
-                message_store[message['id']] = msg
-
-                out_file = os.path.join(local_path, "_".join([msg['internalDate'], msg['id']])) + '.json'
-
-                with open(out_file, "w") as file:
-                    json.dump(msg, file)
-                    file_names.append(file.name)
-
-            return file_names, message_store
-        else:
-            print(f"Persisting to GCP Storage at {bucket_name}/{bucket_path}")
-
-            # Explicitly use service account credentials by specifying the private key file.
-            storage_client = storage.Client.from_service_account_json(
-                credentials_file) 
-
-            bucket = storage_client.get_bucket(bucket_name) 
-
-            for message in messages:
-                msg = service.users().messages().get(userId='me', id=message['id'], format='raw').execute()
-                message_store[message['id']] = msg
-                out_file = os.path.join(bucket_path, "_".join([msg['internalDate'], msg['id']])) + '.json'
-                blob = bucket.blob(out_file)
-                print('blob:', blob)
-                blob.upload_from_string(str(msg))
 
-            return blob.public_url, message_store
+        def fetched():
+            for msg in self.fetch_messages(messages, batch_size=batch_size):
+                message_store[msg['id']] = msg
+                yield msg
+
+        try:
+            with METRICS.timer(stage='persist'):
+                manifest = backend.write_all(fetched())
+        finally:
+            backend.close()
+        for msg_id, error in backend.write_errors.items():
+            logger.error('writing message failed', extra={'msg_id': msg_id, 'error': str(error)})
+            METRICS.inc('storage_write_failures')
+            self.write_errors[msg_id] = error
+            message_store.pop(msg_id, None)
+        written = sum(entry['bytes'] for entry in manifest)
+        METRICS.inc('storage_messages_written', len(manifest))
+        METRICS.inc('storage_bytes_written', written)
+        logger.info('persisted messages to storage', extra={'messages': len(manifest), 'bytes': written})
+        return manifest, message_store
         
 
 def main():
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class HttpCache:
+    """
+    A disk-backed HTTP content cache for conditional GETs. Response bodies are stored as files
+    under `path`, next to a SQLite index with their validators (ETag and Last-Modified), headers,
+    encoding, size and last access time.
+
+    Only responses that carry a validator are stored, since they are the only ones that can be
+    revalidated. When the stored bodies exceed `max_bytes` in total, the least recently used
+    entries are evicted. Served and revalidated entries are counted in `self.hits`, new and
+    changed bodies in `self.misses`.
+    """
+
+    def __init__(self, path='../../data/interim/http_cache', max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, final_url TEXT, encoding TEXT, '
+            'headers TEXT, size INTEGER NOT NULL, accessed_at REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+        self._connection.commit()
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _body_file(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def conditional_headers(self, url):
+        """
+        Builds the request headers to revalidate the cached copy of `url`.
+
+        Returns:
+            a dict with `If-None-Match` and/or `If-Modified-Since`; empty if `url` is not cached.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT etag, last_modified FROM entries WHERE url = ?',
+                                           (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            etag, last_modified = row
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def get(self, url):
+        """
+        Loads the cached copy of `url`, e.g. after the server answered a conditional GET with a 304,
+        and marks it as recently used.
+
+        Returns:
+            a dict with the `final_url`, `encoding`, `headers` and `content` (bytes) of the cached
+            response, or `None` if `url` is not (or no longer) cached.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT final_url, encoding, headers FROM entries WHERE url = ?',
+                                           (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self._body_file(url), 'rb') as file:
+                    content = file.read()
+            except OSError:
+                self._delete(url)
+                self._connection.commit()
+                return None
+            self._connection.execute('UPDATE entries SET accessed_at = ? WHERE url = ?', (time.time(), url))
+            self._connection.commit()
+            self.hits += 1
+        final_url, encoding, headers = row
+        return {'final_url': final_url, 'encoding': encoding, 'headers': json.loads(headers), 'content': content}
+
+    def put(self, url, final_url, headers, encoding, content):
+        """
+        Stores a response body with its validators, evicting least recently used entries if the cache is
+        full. Responses without an ETag or Last-Modified header, or larger than the cache, are not stored.
+
+        Returns:
+            True if the response was stored.
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        with self._lock:
+            self.misses += 1
+            if not (etag or last_modified) or len(content) > self.max_bytes:
+                return False
+            self._delete(url)
+            with open(self._body_file(url), 'wb') as file:
+                file.write(content)
+            self._connection.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (url, etag, last_modified, final_url, encoding, json.dumps(dict(headers)),
+                                      len(content), time.time()))
+            self._size += len(content)
+            self._evict()
+            self._connection.commit()
+        return True
+
+    def _delete(self, url):
+        row = self._connection.execute('SELECT size FROM entries WHERE url = ?', (url,)).fetchone()
+        if row is not None:
+            self._connection.execute('DELETE FROM entries WHERE url = ?', (url,))
+            self._size -= row[0]
+            try:
+                os.remove(self._body_file(url))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._connection.execute('SELECT url FROM entries ORDER BY accessed_at LIMIT 100').fetchall()
+            if not rows:
+                break
+            for (url,) in rows:
+                self._delete(url)
+                if self._size <= self.max_bytes:
+                    break
+
+    def stats(self):
+        """
+        Returns:
+            a dict with the number of cache hits and misses, and the total size of the cached bodies.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self._size}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,19 +1,261 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
+import os
+import threading
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
+from src.data.canonicalize import UrlCanonicalizer, canonicalize_url
+from src.data.corpus_store import CorpusStore
+from src.data.crawler import Crawler
+from src.data.extract_hyperlinks import decode_message
+from src.data.extract_text import extract_text
+from src.data.extract_urls import UrlExtractor
+from src.data.fetch import Fetcher
+from src.data.get_gmails import GMailGetter, chunked
+from src.data.http_cache import HttpCache
+from src.data.message_archive import MessageArchive
+from src.data.metrics import METRICS, use_structured_logging
+from src.data.pipeline import Pipeline, Stage
+from src.data.url_cache import UrlStatusCache
+from src.data.validate_links import LinkValidator
+
+logger = logging.getLogger(__name__)
+
+
+def extract_message(msg):
+    """
+    The extract stage: decodes a raw message into its text, including the text/html part.
+    A module level function, so it can run in a worker process.
+    """
+    msg_id, text = decode_message((msg['id'], msg), include_html=True)
+    return [(msg_id, text)] if text is not None else []
+
+
+def parse_document(document):
+    """
+    The parse stage: extracts the running text from a retrieved (HTML) document.
+    A module level function, so it can run in a worker process.
+    """
+    url, content_type, raw_text = document
+    text = extract_text(raw_text) if 'html' in content_type else raw_text
+    return [(url, content_type, raw_text, text)]
+
+
+class DatasetPipeline:
+    """
+    The pipeline from unread newsletters to parsed articles in the corpus store, as a chain of
+    concurrent stages: list -> fetch -> extract -> link-extract -> validate -> retrieve -> parse.
+
+    Progress is checkpointed in the durable stores the stages write to: every fetched message
+    is appended to the `MessageArchive`, and every retrieved article to the `CorpusStore`.
+    A crashed run can simply be started again; messages are read back from the archive instead of
+    refetched, and links whose article is in the store are not retrieved again. Messages are only
+    marked as read (and the incremental sync checkpoint only advances) once a run completes, and a
+    message is left unread if any of its items failed in a stage, so its links are retried next run.
+    """
+
+    def __init__(self, getter_factory, archive, store, interim_path='../../data/interim', incremental=False,
+                 batch_size=50, workers=None, queue_size=100):
+        self.getter_factory = getter_factory
+        self.getter = getter_factory()
+        self.archive = archive
+        self.store = store
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.workers = {'fetch': 1, 'extract': 1, 'link_extract': 1, 'validate': 16, 'retrieve': 16, 'parse': 1}
+        self.workers.update(workers or {})
+        self.queue_size = queue_size
+
+        url_cache = UrlStatusCache(os.path.join(interim_path, 'url_status.sqlite'))
+        fetcher = Fetcher(cache=HttpCache(os.path.join(interim_path, 'http_cache')))
+        self.url_extractor = UrlExtractor()
+        self.canonicalizer = UrlCanonicalizer(cache=url_cache)
+        self.validator = LinkValidator(cache=url_cache, fetcher=fetcher)
+        self.crawler = Crawler(fetcher=fetcher, max_workers=self.workers['retrieve'])
+
+        # The GMail client is not thread-safe, so every fetch worker gets its own.
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seen_links = set()
+        self._seen_urls = set()
+        # Where the items of later stages came from, to trace failed items back to their messages.
+        self._link_messages = {}
+        self._url_links = {}
+        self.processed_messages = []
+        self.failed_messages = set()
+
+    def list_messages(self):
+        messages = self.getter.get_new_messages() if self.incremental else self.getter.get_unread_messages()
+        return chunked(messages, self.batch_size)
+
+    def fetch(self, messages):
+        to_fetch = []
+        for message in messages:
+            msg = self.archive.get(message['id'])
+            if msg is not None:
+                self._processed(msg)
+                yield msg
+            else:
+                to_fetch.append(message)
+        if not hasattr(self._local, 'getter'):
+            self._local.getter = self.getter_factory()
+        getter = self._local.getter
+        for msg in getter.fetch_messages(to_fetch, batch_size=self.batch_size):
+            self.archive.append(msg)
+            self._processed(msg)
+            yield msg
+        with self._lock:
+            self.getter.fetch_errors.update(getter.fetch_errors)
+
+    def _processed(self, msg):
+        # Messages without a text part never reach the later stages, but are processed all the same.
+        with self._lock:
+            self.processed_messages.append(msg['id'])
+
+    def extract_links(self, decoded):
+        msg_id, text = decoded
+        links = self.url_extractor.extract(text)
+        with self._lock:
+            for link in links:
+                self._link_messages.setdefault(link, []).append(msg_id)
+            new_links = [link for link in links if link not in self._seen_links]
+            self._seen_links.update(new_links)
+        return new_links
+
+    def validate(self, link):
+        # The canonical URL deduplicates and keys the article; the resolved link is what gets requested.
+        fetch_url = self.canonicalizer.resolve(link) if self.canonicalizer.is_tracker(link) else link
+        url = canonicalize_url(fetch_url)
+        with self._lock:
+            self._url_links.setdefault(url, []).append(link)
+            if url in self._seen_urls:
+                return []
+            self._seen_urls.add(url)
+        if url in self.store or self.url_extractor.is_excluded(url):
+            return []
+        return [(url, fetch_url)] if self.validator.status(fetch_url) == 200 else []
+
+    def retrieve(self, urls):
+        url, fetch_url = urls
+        response = self.crawler.fetch(fetch_url)
+        # Raised, so the failure is traced back to the messages of the link and they are left unread.
+        if response is None or response.status_code != 200:
+            status = response.status_code if response is not None else None
+            raise OSError(f'Retrieving {fetch_url} failed with status {status}')
+        if response.text is None:
+            if response.encoding is None:
+                # Not a text page, or too large: the body is skipped on purpose, and would be again next run.
+                return []
+            raise OSError(f'Retrieving {fetch_url} failed: the page could not be decoded as {response.encoding}')
+        return [(url, response.headers.get('content-type', ''), response.text)]
+
+    def run(self):
+        """
+        Runs the pipeline to completion, and marks the processed messages as read.
+
+        Returns:
+            a dict with the number of processed messages and stored documents, and the stats of every stage.
+        """
+        pipeline = Pipeline(self.list_messages(), [
+            Stage('fetch', self.fetch, self.workers['fetch']),
+            Stage('extract', extract_message, self.workers['extract'], processes=self.workers['extract'] > 1),
+            Stage('link_extract', self.extract_links, self.workers['link_extract']),
+            Stage('validate', self.validate, self.workers['validate']),
+            Stage('retrieve', self.retrieve, self.workers['retrieve']),
+            Stage('parse', parse_document, self.workers['parse'], processes=self.workers['parse'] > 1),
+        ], queue_size=self.queue_size)
+
+        stored = 0
+        for url, content_type, raw_text, text in pipeline.run():
+            self.store.add(url, content_type, raw_text, text)
+            stored += 1
+        METRICS.inc('documents_stored', stored)
+
+        self.failed_messages = self._trace_failures(pipeline.errors)
+        if self.failed_messages:
+            METRICS.inc('messages_left_unread', len(self.failed_messages))
+            logger.warning('messages left unread after failed items',
+                           extra={'messages': len(self.failed_messages), 'msg_ids': sorted(self.failed_messages)})
+        to_mark = [msg_id for msg_id in self.processed_messages if msg_id not in self.failed_messages]
+        if to_mark:
+            self.getter.mark_as_read(to_mark)
+        if self.incremental and not self.getter.fetch_errors and not self.failed_messages:
+            self.getter.save_checkpoint(self.getter.latest_history_id)
+        return {'messages': len(to_mark), 'failed_messages': len(self.failed_messages), 'documents': stored,
+                'stages': pipeline.stats()}
+
+    def _trace_failures(self, errors):
+        """
+        Args:
+            errors: the (stage name, item, error) tuples of the items that failed in the pipeline.
+
+        Returns:
+            the set of ids of the processed messages that the failed items came from.
+        """
+        failed = set()
+        for stage, item, _ in errors:
+            if stage == 'fetch':
+                # Messages are only processed once fetched, so the ones in a failed batch are left unread anyway.
+                continue
+            if stage == 'extract':
+                failed.add(item['id'])
+            elif stage == 'link_extract':
+                failed.add(item[0])
+            else:
+                # Validate gets a link; retrieve and parse get tuples that start with the canonical URL.
+                links = [item] if stage == 'validate' else self._url_links.get(item[0], [])
+                for link in links:
+                    failed.update(self._link_messages.get(link, []))
+        return failed
 
 
 @click.command()
-@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('input_filepath', type=click.Path())
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
-    """ Runs data processing scripts to turn raw data from (../raw) into
-        cleaned data ready to be analyzed (saved in ../processed).
+@click.option('--incremental', is_flag=True, help='Only process mail added since the previous run.')
+@click.option('--batch-size', default=50, help='Messages per GMail batch request.')
+@click.option('--queue-size', default=100, help='Maximum number of items waiting between two stages.')
+@click.option('--fetch-workers', default=1)
+@click.option('--extract-workers', default=1, help='More than 1 decodes messages in worker processes.')
+@click.option('--link-extract-workers', default=1)
+@click.option('--validate-workers', default=16)
+@click.option('--retrieve-workers', default=16)
+@click.option('--parse-workers', default=1, help='More than 1 parses documents in worker processes.')
+@click.option('--report', default='reports/run_report.json', type=click.Path(),
+              help='Where to write the JSON run report with the timings and counters of the run.')
+@click.option('--prometheus', default=None, type=click.Path(),
+              help='Where to write the metrics of the run in the Prometheus text format.')
+@click.option('--json-logs', is_flag=True, help='Log one JSON object per line.')
+def main(input_filepath, output_filepath, incremental, batch_size, queue_size, fetch_workers, extract_workers,
+         link_extract_workers, validate_workers, retrieve_workers, parse_workers, report, prometheus, json_logs):
+    """ Runs the pipeline that retrieves unread newsletters into the raw message archive (in ../raw), and the
+        articles they link to into the corpus store (saved in ../processed).
     """
+    use_structured_logging(json_format=json_logs)
     logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
+    METRICS.reset()
+
+    interim_path = os.path.join(os.path.dirname(os.path.abspath(output_filepath)), 'interim')
+    archive = MessageArchive(input_filepath)
+    store = CorpusStore(os.path.join(output_filepath, 'corpus.sqlite'))
+    checkpoint_file = os.path.join(interim_path, 'gmail_checkpoint.json')
+    workers = dict(fetch=fetch_workers, extract=extract_workers, link_extract=link_extract_workers,
+                   validate=validate_workers, retrieve=retrieve_workers, parse=parse_workers)
+
+    pipeline = DatasetPipeline(lambda: GMailGetter(run_pipeline=False, checkpoint_file=checkpoint_file),
+                               archive, store, interim_path=interim_path, incremental=incremental,
+                               batch_size=batch_size, workers=workers, queue_size=queue_size)
+    result = pipeline.run()
+    archive.close()
+    store.close()
+    logger.info('processed messages into new documents',
+                extra={'messages': result['messages'], 'failed_messages': result['failed_messages'],
+                       'documents': result['documents']})
+    logger.info('run report written', extra={'path': METRICS.write_report(report), 'stages': result['stages']})
+    if prometheus is not None:
+        METRICS.write_prometheus(prometheus)
 
 
 if __name__ == '__main__':
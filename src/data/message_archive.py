@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import click
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from pathlib import Path
+from src.data.metrics import use_structured_logging
+
+logger = logging.getLogger(__name__)
+
+
+class MessageArchive:
+    """
+    An append-only archive of raw GMail API messages, replacing one `<internalDate>_<id>.json` file
+    per message in `data/raw`.
+
+    Messages are stored as individually zlib compressed JSON records, packed into segment files
+    of at most `max_segment_bytes` each. A SQLite index maps every message id to its internal
+    date, segment, offset and length, for random access by id and streaming scans by date range.
+    Records are never rewritten: appending a message that is already archived is a no-op.
+    An archive can be shared between threads.
+    """
+
+    def __init__(self, path='../../data/raw', max_segment_bytes=64 * 1024 * 1024, compression_level=6):
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        self.compression_level = compression_level
+        os.makedirs(path, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(path, 'archive_index.sqlite'), check_same_thread=False)
+        self._lock = threading.RLock()
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS messages '
+            '(id TEXT PRIMARY KEY, internal_date INTEGER NOT NULL, segment INTEGER NOT NULL, '
+            'offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date)')
+        self._connection.commit()
+        segment = self._connection.execute('SELECT MAX(segment) FROM messages').fetchone()[0]
+        self._segment = segment if segment is not None else 0
+        self._writer = None
+        self._readers = {}
+
+    def _segment_file(self, segment):
+        return os.path.join(self.path, f'segment-{segment:05d}.zlib')
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def __contains__(self, msg_id):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM messages WHERE id = ?', (msg_id,)).fetchone() is not None
+
+    def append(self, msg, commit=True):
+        """
+        Appends a raw message to the current segment, starting a new segment when it is full.
+
+        Args:
+            msg: a GMail API message object in raw format, with at least `id` and `internalDate`.
+            commit (optional): whether to commit the index right away; pass False when appending many messages.
+
+        Returns:
+            the number of (compressed) bytes appended; 0 if the message was already archived.
+        """
+        record = zlib.compress(json.dumps(msg).encode('utf-8'), self.compression_level)
+        with self._lock:
+            return self._append(msg['id'], int(msg['internalDate']), record, commit)
+
+    def _append(self, msg_id, internal_date, record, commit):
+        if msg_id in self:
+            return 0
+        if self._writer is None:
+            self._writer = open(self._segment_file(self._segment), 'ab')
+        if self._writer.tell() > 0 and self._writer.tell() + len(record) > self.max_segment_bytes:
+            self._writer.close()
+            self._segment += 1
+            self._writer = open(self._segment_file(self._segment), 'ab')
+        offset = self._writer.tell()
+        self._writer.write(record)
+        # The record has to be on disk before the index points at it.
+        self._writer.flush()
+        self._connection.execute('INSERT INTO messages VALUES (?, ?, ?, ?, ?)',
+                                 (msg_id, internal_date, self._segment, offset, len(record)))
+        if commit:
+            self._connection.commit()
+        return len(record)
+
+    def commit(self):
+        """
+        Commits the index entries of the messages appended with `commit=False`.
+        """
+        with self._lock:
+            self._connection.commit()
+
+    def extend(self, msgs):
+        """
+        Appends a collection of raw messages, committing the index once.
+
+        Returns:
+            the ids of the messages that were appended (i.e. were not archived before).
+        """
+        appended = [msg['id'] for msg in msgs if self.append(msg, commit=False)]
+        self.commit()
+        return appended
+
+    def _read(self, segment, offset, length):
+        with self._lock:
+            record = self._read_record(segment, offset, length)
+        return json.loads(zlib.decompress(record).decode('utf-8'))
+
+    def _read_record(self, segment, offset, length):
+        if segment == self._segment and self._writer is not None:
+            self._writer.flush()
+        if segment not in self._readers:
+            self._readers[segment] = open(self._segment_file(segment), 'rb')
+        reader = self._readers[segment]
+        reader.seek(offset)
+        return reader.read(length)
+
+    def get(self, msg_id):
+        """
+        Returns:
+            the archived raw message with id `msg_id`, or `None` if it is not archived.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT segment, offset, length FROM messages WHERE id = ?',
+                                           (msg_id,)).fetchone()
+        return self._read(*row) if row is not None else None
+
+    def scan(self, start_date=None, end_date=None):
+        """
+        Streams the archived messages received in a date range, in order of their internal date, one message at
+        a time. The result can be passed to `InboxDelta.iter_extract` as it is.
+
+        Args:
+            start_date (optional): the earliest internal date (in ms since the epoch) to include.
+            end_date (optional): the internal date (in ms since the epoch) to stop before.
+
+        Yields:
+            tuples (msg_id, raw message).
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'SELECT id, segment, offset, length FROM messages WHERE internal_date >= ? AND internal_date < ? '
+                'ORDER BY internal_date, segment, offset',
+                (start_date if start_date is not None else -2 ** 63, end_date if end_date is not None else 2 ** 63 - 1))
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(256)
+            if not rows:
+                return
+            for msg_id, segment, offset, length in rows:
+                yield msg_id, self._read(segment, offset, length)
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = {}
+            self._connection.close()
+
+
+# The names of the JSON files written by `GMailGetter.persist_to_storage`: <internalDate>_<id>.json.
+MESSAGE_FILE_PATTERN = re.compile(r'^(\d+)_[^.]+\.json$')
+
+
+def load_json(json_file):
+    with open(json_file) as file:
+        return json.load(file)
+
+
+def migrate(json_dir, archive, remove=False):
+    """
+    Packs the `<internalDate>_<id>.json` files written by earlier versions of `GMailGetter.persist_to_storage`
+    into an archive, oldest first. Other JSON files in `json_dir` are skipped.
+
+    Args:
+        json_dir: the directory holding the JSON files.
+        archive: the `MessageArchive` to append the messages to.
+        remove (optional): whether to delete each JSON file once its message is archived.
+
+    Returns:
+        the number of messages appended.
+    """
+    json_files = []
+    for json_file in glob.glob(os.path.join(json_dir, '*.json')):
+        match = MESSAGE_FILE_PATTERN.match(os.path.basename(json_file))
+        if match is None:
+            logger.warning('skipping a file not named <internalDate>_<id>.json', extra={'file': json_file})
+            continue
+        json_files.append((int(match.group(1)), json_file))
+    json_files = [json_file for _, json_file in sorted(json_files)]
+    appended = len(archive.extend(load_json(json_file) for json_file in json_files))
+    if remove:
+        for json_file in json_files:
+            os.remove(json_file)
+    logger.info('archived messages', extra={'appended': appended, 'files': len(json_files), 'path': json_dir})
+    return appended
+
+
+@click.command()
+@click.argument('json_dir', type=click.Path(exists=True))
+@click.argument('archive_dir', type=click.Path())
+@click.option('--remove', is_flag=True, help='Delete the JSON files once they are archived.')
+def main(json_dir, archive_dir, remove):
+    """ Migrates the per-message JSON files in JSON_DIR (e.g. data/raw) into an archive in ARCHIVE_DIR.
+    """
+    archive = MessageArchive(archive_dir)
+    migrate(json_dir, archive, remove=remove)
+    archive.close()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    use_structured_logging()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    main()
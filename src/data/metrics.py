@@ -0,0 +1,238 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets; the last bucket is +Inf.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+# The attributes every `logging.LogRecord` has; anything else was passed with `extra=` and is a structured field.
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _label_string(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ((key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, as a Prometheus histogram does, and keeps their sum.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Returns:
+            a list of tuples (upper bound, number of observations up to that bound), ending with ('+Inf', count).
+        """
+        total = 0
+        cumulative = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class Metrics:
+    """
+    A registry of the counters and histograms of a run, shared by all stages of the pipeline.
+
+    Counters count things (messages, links, cache hits, bytes downloaded, failures); histograms
+    record durations, e.g. the latency of HTTP calls. Both can carry labels, e.g. `stage='parse'`.
+    `timer` times a block of code into the `stage_seconds` histogram, which the run report sums
+    up per stage to show where the wall time goes.
+
+    The registry is thread-safe. Work done in worker processes is not recorded, except by the
+    timers around it in the parent process. Export with `report` (JSON) or `to_prometheus`
+    (the Prometheus text exposition format).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self._counters = {}
+            self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Adds `value` to the counter `name` with the given labels.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Records `value` in the histogram `name` with the given labels.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name='stage_seconds', **labels):
+        """
+        Times the enclosed block into the histogram `name` with the given labels, also when it raises,
+        e.g. `with METRICS.timer(stage='parse'):`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name, **labels):
+        """
+        Returns:
+            the current value of a counter, 0 if it was never incremented.
+        """
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def report(self):
+        """
+        Returns:
+            a JSON serializable dict with the start time and duration of the run, the wall time and number of
+            calls per stage, and all counters and histograms.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            stages = {}
+            for (name, labels), histogram in histograms:
+                if name == 'stage_seconds':
+                    stage = dict(labels)['stage']
+                    totals = stages.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+                    totals['calls'] += histogram.count
+                    totals['seconds'] = round(totals['seconds'] + histogram.sum, 6)
+            return {
+                'started': self.started,
+                'duration': round(time.time() - self.started, 6),
+                'stages': stages,
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in counters],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                                'sum': round(histogram.sum, 6),
+                                'buckets': {str(bound): count for bound, count in histogram.cumulative_counts()}}
+                               for (name, labels), histogram in histograms],
+            }
+
+    def to_prometheus(self, prefix='newslettersortr_'):
+        """
+        Returns:
+            the counters and histograms in the Prometheus text exposition format, with `prefix` before every name.
+        """
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name}_total counter')
+                    typed.add(name)
+                lines.append(f'{prefix}{name}_total{_label_string(labels)} {value}')
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                    typed.add(name)
+                for bound, count in histogram.cumulative_counts():
+                    lines.append(f'{prefix}{name}_bucket{_label_string(labels, [("le", str(bound))])} {count}')
+                lines.append(f'{prefix}{name}_sum{_label_string(labels)} {histogram.sum}')
+                lines.append(f'{prefix}{name}_count{_label_string(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path='../../reports/run_report.json'):
+        """
+        Writes the `report` to a JSON file.
+
+        Returns:
+            the path of the report.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        return path
+
+    def write_prometheus(self, path='../../reports/metrics.prom'):
+        """
+        Writes the metrics in the Prometheus text format, e.g. for the textfile collector of the node exporter.
+
+        Returns:
+            the path of the file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(self.to_prometheus())
+        return path
+
+
+# The registry the pipeline stages record to.
+METRICS = Metrics()
+
+
+def _extra_fields(record):
+    # Anything that is not a standard attribute of a record was passed with `extra=`.
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats log records in the usual text format, followed by the fields passed with `extra=` as `key=value` pairs.
+    """
+
+    def format(self, record):
+        fields = ' '.join(f'{key}={value}' for key, value in _extra_fields(record).items())
+        message = super().format(record)
+        return f'{message} {fields}' if fields else message
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line, with the time, level, logger and message, plus every
+    field passed with `extra=`, e.g. `logger.info('fetched messages', extra={'messages': 50})`.
+    """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def use_structured_logging(json_format=False, logger=None):
+    """
+    Makes the handlers of `logger` (the root logger by default) show the structured fields of log records, as
+    `key=value` pairs after the message, or with `json_format` as one JSON object per line.
+    """
+    for handler in (logger or logging.getLogger()).handlers:
+        if json_format:
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(KeyValueFormatter(handler.formatter._fmt if handler.formatter else None))
@@ -0,0 +1,229 @@
+import collections
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+from src.data.metrics import METRICS
+
+# Hashes are taken modulo this (Mersenne) prime; shingle hashes are 32 bits, so a * x + b fits in 64 bits.
+MERSENNE_PRIME = (1 << 31) - 1
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def shingle_hashes(text, shingle_size=5):
+    """
+    Args:
+        text: the text of a document.
+        shingle_size (optional): the number of consecutive words per shingle.
+
+    Returns:
+        the distinct 32-bit hashes of the word shingles of `text`, as an array; a text shorter than a shingle
+        is a single shingle, and a text without words has none.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    shingles.discard('')
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64,
+                       count=len(shingles))
+
+
+class NearDuplicateIndex:
+    """
+    Detects near-duplicate documents, e.g. the same story syndicated across sites, with MinHash
+    signatures and locality sensitive hashing (LSH).
+
+    A document's signature holds the minimum of `num_perm` random hash functions over its word
+    shingles; two signatures agree in a position with a probability equal to the Jaccard similarity
+    of the documents. Signatures are cut into `bands` bands, and documents whose signatures are
+    identical in any band become candidates, so a lookup costs one indexed query instead of a
+    comparison with every document. Candidates whose estimated similarity is at least `threshold`
+    are near-duplicates.
+
+    The index is persisted in SQLite at `path`. Every document is added with its canonical document:
+    itself, or the document it is a near-duplicate of. Lookup latencies and the dedupe rate are
+    reported by `stats`.
+    """
+
+    def __init__(self, path='../../data/interim/near_duplicates.sqlite', num_perm=128, bands=16, threshold=.8,
+                 shingle_size=5, seed=1):
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, MERSENNE_PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self._b = rng.randint(0, MERSENNE_PRIME, size=(num_perm, 1)).astype(np.uint64)
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript(
+            'CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS documents '
+            '(content_hash TEXT PRIMARY KEY, signature BLOB NOT NULL, canonical_hash TEXT NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS buckets (bucket INTEGER NOT NULL, content_hash TEXT NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (bucket);')
+        settings = {'num_perm': num_perm, 'bands': bands, 'shingle_size': shingle_size, 'seed': seed}
+        for name, value in settings.items():
+            self._connection.execute('INSERT OR IGNORE INTO settings VALUES (?, ?)', (name, str(value)))
+        stored = dict(self._connection.execute('SELECT name, value FROM settings').fetchall())
+        self._connection.commit()
+        if stored != {name: str(value) for name, value in settings.items()}:
+            raise ValueError(f'The index in {path} was built with {stored}, not {settings}')
+
+        self.checked = 0
+        self.duplicates = 0
+        self._latencies = collections.deque(maxlen=10000)
+
+    def signature(self, text):
+        """
+        Returns:
+            the MinHash signature of `text`, an array of `num_perm` 32-bit values.
+        """
+        hashes = shingle_hashes(text, self.shingle_size)
+        if not len(hashes):
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint32)
+        return ((self._a * hashes + self._b) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def _buckets(self, signature):
+        # One key per band, which includes the band number so equal rows in different bands don't collide.
+        bands = signature.reshape(self.bands, self.rows)
+        return [int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8, key=i.to_bytes(2, 'big')).digest(),
+                               'big', signed=True)
+                for i, band in enumerate(bands)]
+
+    def query(self, signature):
+        """
+        Finds the near-duplicates of a document among the indexed documents.
+
+        Args:
+            signature: the MinHash signature of the document, see `signature`.
+
+        Returns:
+            a list of tuples (content_hash, canonical_hash, estimated similarity) of the indexed documents with
+            an estimated Jaccard similarity of at least `threshold`, most similar first.
+        """
+        buckets = self._buckets(signature)
+        with self._lock:
+            rows = self._connection.execute(
+                f'SELECT d.content_hash, d.canonical_hash, d.signature FROM documents d WHERE d.content_hash IN '
+                f'(SELECT content_hash FROM buckets WHERE bucket IN ({", ".join("?" * len(buckets))}))',
+                buckets).fetchall()
+        matches = []
+        for content_hash, canonical_hash, blob in rows:
+            similarity = float(np.mean(np.frombuffer(blob, dtype=np.uint32) == signature))
+            if similarity >= self.threshold:
+                matches.append((content_hash, canonical_hash, similarity))
+        return sorted(matches, key=lambda match: -match[2])
+
+    def add(self, content_hash, text, commit=True):
+        """
+        Looks up the near-duplicates of a document and adds it to the index. A document that was added before
+        keeps the canonical document it was given then.
+
+        Args:
+            content_hash: the content hash of the document.
+            text: the (parsed) text of the document.
+            commit (optional): whether to commit right away; pass False when adding many documents.
+
+        Returns:
+            the content hash of the canonical document: `content_hash` itself if the document is not a
+            near-duplicate of an indexed document, else the canonical document of the most similar one.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT canonical_hash FROM documents WHERE content_hash = ?',
+                                           (content_hash,)).fetchone()
+        if row is not None:
+            return row[0]
+        start = time.perf_counter()
+        signature = self.signature(text)
+        matches = self.query(signature)
+        elapsed = time.perf_counter() - start
+        self._latencies.append(elapsed)
+        METRICS.observe('near_duplicate_lookup_seconds', elapsed)
+        canonical_hash = matches[0][1] if matches else content_hash
+        with self._lock:
+            self._connection.execute('INSERT INTO documents VALUES (?, ?, ?)',
+                                     (content_hash, signature.tobytes(), canonical_hash))
+            self._connection.executemany('INSERT INTO buckets VALUES (?, ?)',
+                                         [(bucket, content_hash) for bucket in self._buckets(signature)])
+            if commit:
+                self._connection.commit()
+        self.checked += 1
+        if canonical_hash != content_hash:
+            self.duplicates += 1
+            METRICS.inc('near_duplicates')
+        METRICS.inc('near_duplicate_checks')
+        return canonical_hash
+
+    def canonical(self, content_hash):
+        """
+        Returns:
+            the content hash of the canonical document of an indexed document, or `None` if it is not indexed.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT canonical_hash FROM documents WHERE content_hash = ?',
+                                           (content_hash,)).fetchone()
+        return row[0] if row is not None else None
+
+    def filter(self, documents, commit_every=1000):
+        """
+        Adds a stream of documents to the index and passes on the canonical ones, dropping near-duplicates.
+        Documents without text are passed on as they are.
+
+        Args:
+            documents: an iterable of dicts with (at least) the `content_hash` and `text` of every document, as
+                yielded by `CorpusStore.iter_documents`.
+            commit_every (optional): the number of documents added per transaction.
+
+        Yields:
+            the documents that are their own canonical document.
+        """
+        added = 0
+        try:
+            for document in documents:
+                if not document.get('text'):
+                    yield document
+                    continue
+                if self.add(document['content_hash'], document['text'], commit=False) == document['content_hash']:
+                    yield document
+                added += 1
+                if added % commit_every == 0:
+                    self.commit()
+        finally:
+            self.commit()
+
+    def stats(self):
+        """
+        Returns:
+            a dict with the number of indexed documents and near-duplicates in total, the documents checked and
+            near-duplicates found by this instance, its dedupe rate, and the median and 95th percentile of its
+            lookup latencies in milliseconds.
+        """
+        with self._lock:
+            documents, duplicates = self._connection.execute(
+                'SELECT COUNT(*), SUM(canonical_hash != content_hash) FROM documents').fetchone()
+        latencies = np.array(self._latencies) * 1000
+        return {'documents': documents, 'duplicates': duplicates or 0, 'checked': self.checked,
+                'found': self.duplicates, 'dedupe_rate': self.duplicates / self.checked if self.checked else 0.0,
+                'lookup_ms_p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'lookup_ms_p95': float(np.percentile(latencies, 95)) if len(latencies) else None}
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
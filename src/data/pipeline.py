@@ -0,0 +1,152 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from src.data.metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the items on a queue.
+_DONE = object()
+
+
+def _call(function, item):
+    # Runs in a worker process, where generators can't be sent back; materialize the outputs.
+    return list(function(item) or ())
+
+
+class Stage:
+    """
+    A step of a `Pipeline`: applies `function` to every item that comes in, on `workers` threads.
+
+    `function` takes one item and returns an iterable of output items (possibly empty, or a
+    generator), so a stage can filter, transform and fan out items. With `processes=True` the
+    calls run in a pool of `workers` processes instead, for CPU-bound work; `function` must then
+    be a module level function, and its outputs are sent back all at once.
+    """
+
+    def __init__(self, name, function, workers=1, processes=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+        self.received = 0
+        self.emitted = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'received': self.received, 'emitted': self.emitted, 'failed': self.failed,
+                'busy_time': round(self.busy_time, 3)}
+
+
+class Pipeline:
+    """
+    Runs a source of items through a sequence of `Stage`s, connected by bounded queues of
+    `queue_size` items, so that all stages work at the same time. A stage that falls behind
+    fills its input queue, which blocks the stage before it (backpressure) instead of letting
+    intermediate results pile up in memory.
+
+    An item for which a stage raises an exception is dropped (and counted as failed) without
+    stopping the pipeline, unless the exception is raised by the source.
+    """
+
+    def __init__(self, source, stages, queue_size=100):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.errors = []
+        self._error_lock = threading.Lock()
+
+    def _record_error(self, stage_name, item, error):
+        with self._error_lock:
+            self.errors.append((stage_name, item, error))
+        METRICS.inc('pipeline_failures', stage=stage_name)
+        logger.error('pipeline stage failed', extra={'stage': stage_name, 'item': f'{item!r:.80}', 'error': repr(error)})
+
+    def _feed(self, source, output_queue, failure):
+        try:
+            for item in source:
+                output_queue.put(item)
+        except BaseException as error:
+            failure.append(error)
+        finally:
+            output_queue.put(_DONE)
+
+    def _work(self, stage, input_queue, output_queue, remaining, pool):
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                # Let the other workers of this stage see the end too; the last one passes it on.
+                input_queue.put(_DONE)
+                with stage._lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    output_queue.put(_DONE)
+                return
+            start = time.perf_counter()
+            emitted = 0
+            try:
+                if pool is not None:
+                    outputs = pool.submit(_call, stage.function, item).result()
+                else:
+                    outputs = stage.function(item) or ()
+                for output in outputs:
+                    output_queue.put(output)
+                    emitted += 1
+                failed = 0
+            except Exception as error:
+                self._record_error(stage.name, item, error)
+                failed = 1
+            elapsed = time.perf_counter() - start
+            METRICS.observe('stage_seconds', elapsed, stage=stage.name)
+            METRICS.inc('pipeline_items', emitted, stage=stage.name)
+            with stage._lock:
+                stage.received += 1
+                stage.emitted += emitted
+                stage.failed += failed
+                stage.busy_time += elapsed
+
+    def run(self):
+        """
+        Starts the pipeline and yields the outputs of the last stage as they come out.
+
+        Yields:
+            the output items of the last stage, in no particular order.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        failure = []
+        threads = [threading.Thread(target=self._feed, args=(self.source, queues[0], failure), daemon=True)]
+        pools = []
+        for index, stage in enumerate(self.stages):
+            pool = ProcessPoolExecutor(max_workers=stage.workers) if stage.processes else None
+            if pool is not None:
+                pools.append(pool)
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work, daemon=True,
+                                                args=(stage, queues[index], queues[index + 1], remaining, pool)))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            for pool in pools:
+                pool.shutdown()
+        if failure:
+            raise failure[0]
+
+    def stats(self):
+        """
+        Returns:
+            a dict {stage name: stats} with the items received, emitted and failed by every stage, and the time its
+            workers spent on them.
+        """
+        return {stage.name: stage.stats() for stage in self.stages}
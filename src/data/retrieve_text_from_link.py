@@ -2,77 +2,92 @@
 import click
 
 import logging
-import requests
-from os.path import exists
-from bs4 import BeautifulSoup
+import time
 from pathlib import Path
 # from dotenv import find_dotenv, load_dotenv
 from src.data.get_gmails import GMailGetter
 from src.data.extract_hyperlinks import InboxDelta
-from joblib import dump, load
-from string import punctuation
+from src.data.corpus_store import CorpusStore
+from src.data.crawler import Crawler
+from src.data.extract_text import parse_corpus
+from src.data.fetch import Fetcher
+from src.data.http_cache import HttpCache
+from src.data.metrics import METRICS, use_structured_logging
+from src.data.url_cache import UrlStatusCache
+from src.data.validate_links import LinkValidator
+
+logger = logging.getLogger(__name__)
 
 
 class LinkParser:
-    def __init__(self, hyperlink_list, run_pipeline=True):
+    def __init__(self, hyperlink_list, run_pipeline=True, fetcher=None, crawler=None, fetch_urls=None):
         self.link_list = hyperlink_list
+        self.crawler = crawler if crawler is not None else Crawler(fetcher=fetcher)
         if run_pipeline:
-            self.corpus = self.retrieve_text(hyperlink_list)
+            self.corpus = self.retrieve_text(hyperlink_list, fetch_urls=fetch_urls)
+
+    def retrieve_text(self, hyperlinks, fetch_urls=None):
+        """
+        :param hyperlinks: A list of hyperlinks to retrieve.
+        :param fetch_urls: A dict {hyperlink: URL to request} for hyperlinks that are requested with another URL, such
+        as the canonical URLs returned by `InboxDelta.parse`, see `InboxDelta.fetch_urls`.
 
-    def retrieve_text(self, hyperlinks):
+        Retrieves the pages behind the hyperlinks concurrently with `self.crawler`. Pages its fetcher already
+        downloaded while validating the links are taken over as they are, so no link is downloaded twice.
+
+        :return corpus: A dict with structure {link: (content_type, text)}, for the pages whose body was downloaded,
+        i.e. text pages within the fetcher's size limit, decoded in their detected encoding.
+        """
         corpus = {}
-        for link in hyperlinks:
-            response = requests.get(link)
-            print(response.status_code)
-            print(response.headers['content-type'])
-            if response.encoding == 'utf-8':
-                corpus[link] = (response.headers['content-type'], response.text)
+        with METRICS.timer(stage='retrieve'):
+            responses = self.crawler.crawl([(fetch_urls or {}).get(link, link) for link in hyperlinks])
+        for link, response in zip(hyperlinks, responses):
+            if response is None or response.text is None:
+                METRICS.inc('documents_skipped')
+                continue
+            content_type = response.headers.get('content-type', '')
+            METRICS.inc('documents_retrieved', content_type=content_type.split(';')[0].strip().lower())
+            corpus[link] = (content_type, response.text)
         return corpus
 
-    def parse_text(self, corpus):
-        for link, text_tpl in corpus.items():
-            if 'html' in text_tpl[0]:
-                tmp_soup = BeautifulSoup(text_tpl[1], "html5lib")
-                tmp_output = ''
-                counter = 0
-                for line in tmp_soup.prettify().split("\n"):
-                    #if len(line) > 200: # TODO: Check is this setting is appropriate, make data-driven
-                    punctset = [f for f in line if f in punctuation]
-                    punctuation_counts = len(punctset)
-                    if punctuation_counts / (len(line)+.0000000000000000001) < .1: # TODO: Check if this setting is appropriate, make data-driven
-                        tmp_output = tmp_output + line
-                    counter +=1
-                if counter == 0:
-                    print(link)
-                    print('\n\n')
-                    print(tmp_soup)
-                    print('\n\n')
-                    print("Nothing mined... :(")
-                    print('\n\n\n\n\n\n')
-                corpus[link] = tmp_output
-        return corpus
+    def parse_text(self, corpus, processes=None):
+        """
+        :param corpus: A dict with structure {link: (content_type, text)}, as returned by `retrieve_text`.
+        :param processes: The number of worker processes to parse the documents with, or None to parse them in the
+        current process.
+
+        Extracts the running text from the HTML documents in the corpus, see `extract_text`.
+
+        :return corpus: The corpus, updated in place to structure {link: text} for the HTML documents.
+        """
+        return parse_corpus(corpus, processes=processes)
 
 
 def main():
-    if not exists ("./parser.jbl"):
-        mails = GMailGetter()
-        messages = InboxDelta(mails.retrieved_delta)
-        parser = LinkParser(messages.hyperlinks)
-        dump(parser, "parser.jbl")
-    else:
-        parser = load("./parser.jbl")
+    store = CorpusStore()
+    run_started = time.time()
+    METRICS.reset()
+
+    mails = GMailGetter()
+    # One fetcher for both link stages, so validated pages go straight into the corpus.
+    fetcher = Fetcher(cache=HttpCache())
+    validator = LinkValidator(cache=UrlStatusCache(), fetcher=fetcher)
+    # Articles from earlier runs are already in the store, so they are neither validated nor retrieved again.
+    messages = InboxDelta(mails.retrieved_delta, validator=validator, known_urls=store)
+    parser = LinkParser(messages.hyperlinks, fetcher=fetcher, fetch_urls=messages.fetch_urls)
+    raw_corpus = dict(parser.corpus)
     crp = parser.parse_text(parser.corpus)
+    store.add_corpus(raw_corpus, crp)
 
-    for key, val in crp.items():
-        print(key)
-        print('\n')
-        print(val)
-        print('\n\n')
+    for document in store.iter_documents(since=run_started, fields=('url', 'text')):
+        logger.info('new document', extra={'url': document['url'], 'characters': len(document['text'] or '')})
+    logger.info('run report written', extra={'path': METRICS.write_report(), 'stages': METRICS.report()['stages']})
     # TODO: Parse message content into usable text :)
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
+    use_structured_logging()
 
     # not used in this stub but often useful for finding various files
     project_dir = Path(__file__).resolve().parents[2]
@@ -0,0 +1,147 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+from src.data.message_archive import MessageArchive
+
+
+def serialize_message(msg):
+    """
+    Serializes a raw GMail API message the same way for every storage backend.
+
+    Returns:
+        the message as utf-8 encoded JSON.
+    """
+    return json.dumps(msg).encode('utf-8')
+
+
+def object_name(msg, prefix=''):
+    """
+    Returns:
+        the name a message is stored under in object storage, `<prefix>/<internalDate>_<id>.json`.
+    """
+    # TODO: msg['payload']['headers'][ITEREER if name=Received]['value'] om de afzender op te nemen in filename
+    return os.path.join(prefix, "_".join([msg['internalDate'], msg['id']])) + '.json'
+
+
+class StorageBackend(ABC):
+    """
+    The interface of the places `GMailGetter.persist_to_storage` can write raw messages to.
+
+    `write` stores a single message and `write_all` a (possibly lazy) collection of them; both
+    return manifest entries, dicts with the message `id`, the `location` it was written to and
+    the number of `bytes` written. Backends that write messages independently of each other record
+    a message that could not be written in `write_errors` as {msg_id: error}, and leave it out of
+    the manifest, instead of failing the whole collection.
+    """
+
+    def __init__(self):
+        self.write_errors = {}
+
+    @abstractmethod
+    def write(self, msg):
+        pass
+
+    def write_all(self, msgs):
+        return [self.write(msg) for msg in msgs]
+
+    def close(self):
+        pass
+
+
+class LocalStorage(StorageBackend):
+    """
+    Writes messages to a `MessageArchive` on the local filesystem. The archive is a single
+    append-only file, so messages are written one after another; they are reported with their
+    compressed size, or 0 bytes if they were already archived.
+    """
+
+    def __init__(self, path='../../data/raw'):
+        super().__init__()
+        self.archive = MessageArchive(path)
+
+    def write(self, msg):
+        return self._entry(msg, self.archive.append(msg))
+
+    def write_all(self, msgs):
+        # Commit the index once at the end rather than per message.
+        manifest = [self._entry(msg, self.archive.append(msg, commit=False)) for msg in msgs]
+        self.archive.commit()
+        return manifest
+
+    def _entry(self, msg, written):
+        return {'id': msg['id'], 'location': f"{self.archive.path}#{msg['id']}", 'bytes': written}
+
+    def close(self):
+        self.archive.close()
+
+
+class GCSStorage(StorageBackend):
+    """
+    Writes messages as JSON objects to a Google Cloud Storage bucket, uploading up to `max_workers`
+    objects concurrently.
+
+    Authenticates with the service account in `credentials_file`. When the `STORAGE_EMULATOR_HOST`
+    environment variable is set, connects to that local emulator anonymously instead.
+    """
+
+    def __init__(self, bucket_name, bucket_path='', credentials_file=None, max_workers=16, project=None):
+        super().__init__()
+        if os.environ.get('STORAGE_EMULATOR_HOST'):
+            client = storage.Client(project=project or 'emulator', credentials=AnonymousCredentials())
+        elif credentials_file is not None:
+            # Explicitly use service account credentials by specifying the private key file.
+            client = storage.Client.from_service_account_json(credentials_file)
+        else:
+            client = storage.Client(project=project)
+        self.bucket = client.bucket(bucket_name)
+        self.bucket_path = bucket_path or ''
+        self.max_workers = max_workers
+
+    def write(self, msg):
+        data = serialize_message(msg)
+        blob = self.bucket.blob(object_name(msg, self.bucket_path))
+        blob.upload_from_string(data, content_type='application/json')
+        return {'id': msg['id'], 'location': f'gs://{self.bucket.name}/{blob.name}', 'bytes': len(data)}
+
+    def write_all(self, msgs):
+        """
+        Uploads a (possibly lazy) collection of messages on a bounded worker pool. At most twice `max_workers`
+        uploads are pending at any time, so a lazy collection is consumed as fast as it can be uploaded. A failed
+        upload is recorded in `self.write_errors` and does not stop the other uploads.
+
+        Returns:
+            the manifest entries of the uploaded messages, in the order of `msgs`.
+        """
+        futures = []
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for msg in msgs:
+                if len(pending) >= 2 * self.max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(self.write, msg)
+                futures.append((msg['id'], future))
+                pending.add(future)
+        manifest = []
+        for msg_id, future in futures:
+            try:
+                manifest.append(future.result())
+            except Exception as error:  # Any failed upload, e.g. a GoogleAPICallError or a connection error.
+                self.write_errors[msg_id] = error
+        return manifest
+
+
+def make_backend(local_path='../../data/raw', credentials_file=None, bucket_name=None, bucket_path=None,
+                 max_workers=16):
+    """
+    Picks the storage backend for the given settings: GCS if a bucket is given, the local archive otherwise.
+
+    Returns:
+        a `StorageBackend`.
+    """
+    if bucket_name is None:
+        return LocalStorage(local_path)
+    return GCSStorage(bucket_name, bucket_path, credentials_file=credentials_file, max_workers=max_workers)
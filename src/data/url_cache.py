@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+# Enforce the size bound on the first write and every this many writes after that.
+EVICT_EVERY = 1000
+
+
+def normalize_url(url):
+    """
+    Normalizes a URL for use as a cache key: lowercases the scheme and host and drops the fragment.
+
+    Args:
+        url: the URL to normalize.
+
+    Returns:
+        the normalized URL as a string.
+    """
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
+
+
+class UrlStatusCache:
+    """
+    An on-disk SQLite cache of hyperlink validation results, mapping a normalized URL to the
+    last status code, the final URL after redirects and the time it was checked.
+
+    Positive (status 200) results are trusted for `positive_ttl` seconds, anything else for
+    `negative_ttl` seconds. When the cache grows beyond `max_entries`, the entries checked
+    longest ago are evicted (checked periodically, so it may briefly overshoot). Hits and
+    misses are counted in `self.hits` and `self.misses`.
+    """
+
+    def __init__(self, path='../../data/interim/url_status.sqlite', positive_ttl=7 * 24 * 3600,
+                 negative_ttl=24 * 3600, max_entries=100000):
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS url_status '
+            '(url TEXT PRIMARY KEY, status INTEGER, final_url TEXT, checked_at REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS url_status_checked_at ON url_status (checked_at)')
+        self._connection.commit()
+
+    def get(self, url):
+        """
+        Looks up a fresh validation result for `url`.
+
+        Returns:
+            a tuple (status_code, final_url), or `None` if there is no result or it has expired.
+            The status code is `None` when the link could not be requested at all.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT status, final_url, checked_at FROM url_status WHERE url = ?',
+                                           (normalize_url(url),)).fetchone()
+            if row is not None:
+                status, final_url, checked_at = row
+                ttl = self.positive_ttl if status == 200 else self.negative_ttl
+                if time.time() - checked_at < ttl:
+                    self.hits += 1
+                    return status, final_url
+            self.misses += 1
+            return None
+
+    def put(self, url, status, final_url=None):
+        """
+        Stores the validation result of `url`, evicting the oldest entries if the cache is full.
+        """
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO url_status VALUES (?, ?, ?, ?)',
+                                     (normalize_url(url), status, final_url, time.time()))
+            self._puts += 1
+            # Counting rows is a full scan, so the size bound is only enforced every `EVICT_EVERY` writes.
+            if self._puts % EVICT_EVERY == 1:
+                self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        count = self._connection.execute('SELECT COUNT(*) FROM url_status').fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute(
+                'DELETE FROM url_status WHERE url IN '
+                '(SELECT url FROM url_status ORDER BY checked_at LIMIT ?)', (count - self.max_entries,))
+
+    def stats(self):
+        """
+        Returns:
+            a dict with the number of cache hits and misses, and the hit ratio.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._connection.commit()
+            self._connection.close()
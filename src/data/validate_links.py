@@ -0,0 +1,104 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from src.data.fetch import make_session
+from src.data.metrics import METRICS
+
+
+class LinkValidator:
+    """
+    Checks concurrently which of a list of hyperlinks resolve to a 200 response.
+
+    Every link is requested with HEAD first, falling back to GET for servers that do not answer
+    HEAD requests properly. Requests share one pooled session, run on a thread pool of
+    `max_workers` threads, and at most `per_host_limit` requests are in flight per host.
+    If a `UrlStatusCache` is passed as `cache`, fresh results are served from it without
+    touching the network, and new results are stored in it.
+
+    If a `Fetcher` is passed as `fetcher`, links are validated with a full GET through it
+    instead, so the downloaded pages can be reused by `LinkParser.retrieve_text`.
+    """
+
+    def __init__(self, max_workers=16, per_host_limit=4, timeout=10, session=None, cache=None, fetcher=None):
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.cache = cache
+        self.fetcher = fetcher
+        self.session = session if session is not None else make_session(max_workers)
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def _host_limit(self, link):
+        host = urlsplit(link).netloc.lower()
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self._host_limits[host]
+
+    def status(self, link):
+        """
+        :param link: the hyperlink to check.
+
+        Looks up `link` in the cache, if any. Otherwise requests it with HEAD and, if that does not return
+        a 200, with a streamed GET whose body is never read; or with a GET through the fetcher, if any.
+        Redirects are followed in all cases.
+
+        :return status_code: the final HTTP status code, or None if the link could not be requested.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(link)
+            METRICS.inc('url_status_cache_lookups', result='miss' if cached is None else 'hit')
+            if cached is not None:
+                return cached[0]
+        status_code, final_url = self._request(link)
+        if self.cache is not None:
+            self.cache.put(link, status_code, final_url)
+        return status_code
+
+    def _request(self, link):
+        with self._host_limit(link):
+            if self.fetcher is not None:
+                result = self.fetcher.fetch(link)
+                return (result.status_code, result.final_url) if result is not None else (None, None)
+            try:
+                response = self._timed(self.session.head, link)
+                if response.status_code == 200:
+                    return 200, response.url
+                with self._timed(self.session.get, link, stream=True) as response:
+                    return response.status_code, response.url
+            except (requests.RequestException, ValueError):
+                return None, None
+
+    def _timed(self, request, link, **kwargs):
+        # Records the latency (up to the response headers) and the outcome of a single request.
+        method = request.__name__.upper()
+        start = time.perf_counter()
+        try:
+            response = request(link, allow_redirects=True, timeout=self.timeout, **kwargs)
+        except (requests.RequestException, ValueError):
+            METRICS.inc('http_requests', method=method, status='error')
+            raise
+        finally:
+            METRICS.observe('http_request_seconds', time.perf_counter() - start, method=method)
+        METRICS.inc('http_requests', method=method, status=response.status_code)
+        return response
+
+    def validate(self, links):
+        """
+        :param links: an iterable of hyperlinks, possibly containing duplicates.
+
+        Deduplicates the links and checks them concurrently.
+
+        :return valid_links: the links that returned status 200, deduplicated and in order of first appearance.
+        """
+        unique_links = list(dict.fromkeys(links))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            codes = list(executor.map(self.status, unique_links))
+        valid_links = [link for link, code in zip(unique_links, codes) if code == 200]
+        METRICS.inc('links_validated', len(unique_links))
+        METRICS.inc('links_invalid', len(unique_links) - len(valid_links))
+        return valid_links
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from src.data.corpus_store import CorpusStore
+from src.data.metrics import METRICS, use_structured_logging
+from src.data.near_duplicates import NearDuplicateIndex
+
+logger = logging.getLogger(__name__)
+
+# The number of hashed features; collisions are rare enough at 2**20 for a corpus of newsletter articles.
+N_FEATURES = 2 ** 20
+# Documents added this many seconds before the last featurized one are read again, deduplicated by content hash,
+# so documents stored with the same timestamp are never missed.
+SINCE_OVERLAP = 1.0
+
+
+class FeatureBuilder:
+    """
+    Turns the documents in the `CorpusStore` into TF-IDF weighted sparse feature vectors, streaming
+    them in chunks of `chunk_size` documents.
+
+    Terms are mapped to one of `n_features` columns by a `HashingVectorizer`, so there is no vocabulary
+    to hold in memory or refit. The term counts of every chunk are written to `path` as the `data`,
+    `indices` and `indptr` arrays of a CSR matrix, one .npy file each, together with the content
+    hashes of its rows. The document frequencies are kept next to them and updated with every chunk;
+    the manifest lists the chunks and names the matching document frequencies, and is replaced last,
+    so it is the single commit point of a chunk. IDF weights are only applied when the features are
+    read, so a daily run only costs the new documents: old chunks are never rewritten. Chunks are
+    read memory-mapped.
+    """
+
+    def __init__(self, path='../../data/processed/features', n_features=N_FEATURES, chunk_size=1000,
+                 ngram_range=(1, 1), stop_words='english'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = self._load_manifest()
+        settings = {'n_features': n_features, 'ngram_range': list(ngram_range), 'stop_words': stop_words}
+        if self.manifest.get('settings', settings) != settings:
+            raise ValueError(f"Features in {path} were built with {self.manifest['settings']}, not {settings}")
+        self.manifest['settings'] = settings
+        self.n_features = n_features
+        self.chunk_size = chunk_size
+        self.vectorizer = HashingVectorizer(n_features=n_features, ngram_range=tuple(ngram_range),
+                                            stop_words=stop_words, alternate_sign=False, norm=None,
+                                            dtype=np.float32)
+        self.document_frequencies = self._load_document_frequencies()
+        self.content_hashes = set()
+        for chunk in self.manifest['chunks']:
+            self.content_hashes.update(np.load(self._chunk_file(chunk['name'], 'hashes')).tolist())
+
+    def _load_manifest(self):
+        manifest_file = os.path.join(self.path, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return {'chunks': [], 'n_documents': 0, 'last_added_at': None}
+        with open(manifest_file) as file:
+            return json.load(file)
+
+    def _load_document_frequencies(self):
+        if 'document_frequencies' in self.manifest:
+            return np.load(os.path.join(self.path, self.manifest['document_frequencies']))
+        # Features built before the manifest named their document frequencies may have counted a chunk it doesn't
+        # list, so they are counted again from the chunks.
+        document_frequencies = np.zeros(self.n_features, dtype=np.int64)
+        for chunk in self.manifest['chunks']:
+            indices = np.load(self._chunk_file(chunk['name'], 'indices'), mmap_mode='r')
+            document_frequencies += np.bincount(indices, minlength=self.n_features)
+        return document_frequencies
+
+    def _chunk_file(self, name, array):
+        return os.path.join(self.path, f'{name}.{array}.npy')
+
+    @property
+    def n_documents(self):
+        return self.manifest['n_documents']
+
+    def idf(self):
+        """
+        Returns:
+            the smoothed inverse document frequency of every feature, `log((1 + n) / (1 + df)) + 1`, as in
+            scikit-learn's `TfidfTransformer`.
+        """
+        return (np.log((1 + self.n_documents) / (1 + self.document_frequencies)) + 1).astype(np.float32)
+
+    def count(self, texts):
+        """
+        Returns:
+            a CSR matrix with the hashed term counts of `texts`, one row per text.
+        """
+        return self.vectorizer.transform(texts).tocsr()
+
+    def weigh(self, counts, idf=None):
+        """
+        Applies the IDF weights to a matrix of term counts and normalizes its rows to unit length.
+
+        Args:
+            counts: a CSR matrix of term counts, as returned by `count` or `iter_chunks(tfidf=False)`.
+            idf (optional): the IDF weights to apply; the current ones by default.
+
+        Returns:
+            a new CSR matrix with the TF-IDF weights.
+        """
+        idf = self.idf() if idf is None else idf
+        weighted = sp.csr_matrix((counts.data * idf[counts.indices], counts.indices, counts.indptr),
+                                 shape=counts.shape)
+        return normalize(weighted, copy=False)
+
+    def transform(self, texts):
+        """
+        Returns:
+            the TF-IDF feature vectors of `texts`, weighted with the current IDF, without adding them to the features.
+        """
+        return self.weigh(self.count(texts))
+
+    def build(self, documents):
+        """
+        Adds the features of a stream of documents, skipping the ones that were featurized before and the ones
+        without text, and updates the document frequencies.
+
+        Args:
+            documents: an iterable of dicts with the `content_hash`, `text` and (optionally) `added_at` of every
+                document, as yielded by `CorpusStore.iter_documents`.
+
+        Returns:
+            the number of documents added.
+        """
+        added = 0
+        batch = []
+        for document in documents:
+            if not document.get('text') or document['content_hash'] in self.content_hashes:
+                continue
+            batch.append(document)
+            if len(batch) == self.chunk_size:
+                added += self._add_chunk(batch)
+                batch = []
+        if batch:
+            added += self._add_chunk(batch)
+        return added
+
+    def _add_chunk(self, documents):
+        with METRICS.timer(stage='build_features'):
+            counts = self.count([document['text'] for document in documents])
+            counts.sort_indices()
+            hashes = np.array([document['content_hash'] for document in documents])
+            name = f"chunk-{len(self.manifest['chunks']):05d}"
+            np.save(self._chunk_file(name, 'data'), counts.data)
+            np.save(self._chunk_file(name, 'indices'), counts.indices)
+            np.save(self._chunk_file(name, 'indptr'), counts.indptr)
+            np.save(self._chunk_file(name, 'hashes'), hashes)
+
+            # Every feature that occurs in a document adds one to its document frequency.
+            self.document_frequencies += np.bincount(counts.indices, minlength=self.n_features)
+            self.content_hashes.update(hashes.tolist())
+            self.manifest['chunks'].append({'name': name, 'rows': len(documents)})
+            self.manifest['n_documents'] += len(documents)
+            added_at = [document['added_at'] for document in documents if document.get('added_at') is not None]
+            if added_at:
+                self.manifest['last_added_at'] = max(added_at + [self.manifest['last_added_at'] or 0])
+            self._save_state()
+        METRICS.inc('documents_featurized', len(documents))
+        return len(documents)
+
+    def _save_state(self):
+        # The manifest is the commit point: the document frequencies are written to a new file named after the last
+        # chunk, which only counts once the manifest that lists the chunk is swapped in. After a crash before that,
+        # the previous manifest and document frequencies still match, and the chunk is simply built again.
+        previous = self.manifest.get('document_frequencies', 'document_frequencies.npy')
+        name = os.path.basename(self._chunk_file(self.manifest['chunks'][-1]['name'], 'document_frequencies'))
+        np.save(os.path.join(self.path, name), self.document_frequencies)
+        self.manifest['document_frequencies'] = name
+        manifest_file = os.path.join(self.path, 'manifest.json')
+        with open(manifest_file + '.tmp', 'w') as file:
+            json.dump(self.manifest, file)
+        os.replace(manifest_file + '.tmp', manifest_file)
+        if previous != name and os.path.exists(os.path.join(self.path, previous)):
+            os.remove(os.path.join(self.path, previous))
+
+    def build_from_store(self, store, near_duplicates=None):
+        """
+        Adds the features of the documents added to a `CorpusStore` since the last build.
+
+        Args:
+            store: the `CorpusStore`.
+            near_duplicates (optional): a `NearDuplicateIndex`; near-duplicates of earlier documents are then
+                collapsed into their canonical document and get no features of their own.
+
+        Returns:
+            the number of documents added.
+        """
+        last_added_at = self.manifest['last_added_at']
+        since = last_added_at - SINCE_OVERLAP if last_added_at is not None else None
+        documents = store.iter_documents(since=since, fields=('content_hash', 'text', 'added_at'))
+        if near_duplicates is not None:
+            documents = near_duplicates.filter(documents)
+        return self.build(documents)
+
+    def iter_chunks(self, tfidf=True):
+        """
+        Lazily reads the features chunk by chunk, memory-mapping the stored arrays.
+
+        Args:
+            tfidf (optional): whether to weigh the term counts with the current IDF; pass False for the raw counts,
+                which stay memory-mapped.
+
+        Yields:
+            tuples (content hashes, CSR matrix), one per chunk.
+        """
+        idf = self.idf() if tfidf else None
+        for chunk in self.manifest['chunks']:
+            name = chunk['name']
+            counts = sp.csr_matrix((np.load(self._chunk_file(name, 'data'), mmap_mode='r'),
+                                    np.load(self._chunk_file(name, 'indices'), mmap_mode='r'),
+                                    np.load(self._chunk_file(name, 'indptr'), mmap_mode='r')),
+                                   shape=(chunk['rows'], self.n_features), copy=False)
+            hashes = np.load(self._chunk_file(name, 'hashes')).tolist()
+            yield hashes, (self.weigh(counts, idf) if tfidf else counts)
+
+    def load(self, tfidf=True):
+        """
+        Reads all features into a single matrix.
+
+        Returns:
+            a tuple (content hashes, CSR matrix with a row per document).
+        """
+        hashes, matrices = [], []
+        for chunk_hashes, matrix in self.iter_chunks(tfidf=tfidf):
+            hashes.extend(chunk_hashes)
+            matrices.append(matrix)
+        if not matrices:
+            return hashes, sp.csr_matrix((0, self.n_features), dtype=np.float32)
+        return hashes, sp.vstack(matrices, format='csr')
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--chunk-size', default=1000, help='Documents per chunk of features.')
+@click.option('--dedupe-index', default=None, type=click.Path(),
+              help='The near-duplicate index (e.g. data/interim/near_duplicates.sqlite) to collapse documents with.')
+def main(input_filepath, output_filepath, chunk_size, dedupe_index):
+    """ Builds the features of the documents added to the corpus store (INPUT_FILEPATH, e.g.
+        data/processed/corpus.sqlite) since the last run, into OUTPUT_FILEPATH (e.g. data/processed/features).
+    """
+    store = CorpusStore(input_filepath)
+    builder = FeatureBuilder(output_filepath, chunk_size=chunk_size)
+    near_duplicates = NearDuplicateIndex(dedupe_index) if dedupe_index is not None else None
+    added = builder.build_from_store(store, near_duplicates=near_duplicates)
+    store.close()
+    logger.info('added features', extra={'added': added, 'documents': builder.n_documents})
+    if near_duplicates is not None:
+        logger.info('near-duplicates', extra=near_duplicates.stats())
+        near_duplicates.close()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    use_structured_logging()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    main()
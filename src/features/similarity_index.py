@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
+from src.data.corpus_store import CorpusStore
+from src.data.metrics import METRICS, use_structured_logging
+from src.data.near_duplicates import MERSENNE_PRIME
+from src.features.build_features import N_FEATURES, FeatureBuilder
+
+logger = logging.getLogger(__name__)
+
+# Content hashes are hex SHA-256 digests, stored as fixed-width bytes so they can be memory-mapped.
+HASH_DTYPE = 'S64'
+PENDING = 'pending'
+
+
+def spherical_kmeans(vectors, n_clusters, n_iter=20, seed=0):
+    """
+    Clusters unit vectors by cosine similarity.
+
+    Args:
+        vectors: an array of unit vectors, one per row, at least `n_clusters` of them.
+        n_clusters: the number of clusters.
+        n_iter (optional): the number of iterations.
+        seed (optional): the seed of the initial centers, a random sample of `vectors`.
+
+    Returns:
+        an array of `n_clusters` unit length cluster centers.
+    """
+    rng = np.random.RandomState(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+    for _ in range(n_iter):
+        assignments = (vectors @ centroids.T).argmax(axis=1)
+        members = sp.csr_matrix((np.ones(len(vectors), dtype=vectors.dtype), (assignments, np.arange(len(vectors)))),
+                                shape=(n_clusters, len(vectors)))
+        sums = np.asarray(members @ vectors)
+        # Restart empty clusters at a random vector.
+        empty = ~sums.any(axis=1)
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+        centroids = normalize(sums).astype(vectors.dtype)
+    return centroids
+
+
+class SimilarityIndex:
+    """
+    An approximate nearest neighbour index over the TF-IDF vectors of the articles, for "related
+    articles" queries, as an inverted file (IVF) in NumPy.
+
+    TF-IDF vectors are projected to `dim` dimensions with a sparse random projection, which keeps
+    cosine similarities: every hashed feature adds its weight, with a random sign, to
+    `hashes_per_feature` dimensions picked by universal hash functions, so no projection matrix is
+    stored. Once `train_size` vectors are indexed, they are clustered into `n_lists` lists by
+    spherical k-means; every vector added after that goes to the list of its nearest cluster center.
+    A query only scans the `nprobe` lists whose centers are nearest to it, instead of the whole
+    corpus. Until then, the vectors are kept in a single list that is scanned exhaustively.
+
+    Most of the recall lost against exact TF-IDF search is lost in the projection, not in the lists:
+    on the synthetic corpus of `benchmarks/bench_similarity.py`, scanning 4 of 128 lists finds over
+    99% of the nearest projected vectors, while the recall@10 against TF-IDF search is about 0.60,
+    0.70, 0.78 and 0.83 for 128, 256, 512 and 1024 dimensions. Query time and the size of the lists
+    grow linearly with `dim`; 512 is the default. More than one hash per feature did not help.
+
+    Every list is an append-only file of float32 vectors in `path`, with a file of the content hashes
+    of its rows, and is read memory-mapped. The manifest records the rows of every list, so rows
+    written by an interrupted insert are discarded when the index is opened again. The cluster
+    centers are not updated after training; delete the index to retrain it on the current corpus.
+    """
+
+    def __init__(self, path='../../data/processed/similarity', n_features=N_FEATURES, dim=512, n_lists=128,
+                 nprobe=8, train_size=None, hashes_per_feature=1, seed=0):
+        self.path = path
+        os.makedirs(os.path.join(path, 'lists'), exist_ok=True)
+        train_size = train_size or 32 * n_lists
+        settings = {'n_features': n_features, 'dim': dim, 'n_lists': n_lists, 'train_size': train_size,
+                    'hashes_per_feature': hashes_per_feature, 'seed': seed}
+        self.manifest = self._load_manifest()
+        if self.manifest.get('settings', settings) != settings:
+            raise ValueError(f"The index in {path} was built with {self.manifest['settings']}, not {settings}")
+        self.manifest['settings'] = settings
+        self.n_features = n_features
+        self.dim = dim
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.train_size = train_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, MERSENNE_PRIME, size=(hashes_per_feature, 1)).astype(np.uint64)
+        self._b = rng.randint(0, MERSENNE_PRIME, size=(hashes_per_feature, 1)).astype(np.uint64)
+        self.centroids = (np.load(os.path.join(path, 'centroids.npy')) if self.manifest['trained'] else None)
+
+        self._lists = {}
+        self.content_hashes = set()
+        for name, rows in self.manifest['lists'].items():
+            self._truncate(name, rows)
+            self.content_hashes.update(content_hash.decode('ascii') for content_hash in self._read(name)[1])
+
+    def _load_manifest(self):
+        manifest_file = os.path.join(self.path, 'manifest.json')
+        if not os.path.exists(manifest_file):
+            return {'trained': False, 'lists': {PENDING: 0}, 'indexed_chunks': [], 'n_vectors': 0}
+        with open(manifest_file) as file:
+            return json.load(file)
+
+    def _save_manifest(self):
+        manifest_file = os.path.join(self.path, 'manifest.json')
+        with open(manifest_file + '.tmp', 'w') as file:
+            json.dump(self.manifest, file)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _list_files(self, name):
+        return (os.path.join(self.path, 'lists', f'{name}.vectors'),
+                os.path.join(self.path, 'lists', f'{name}.hashes'))
+
+    def _truncate(self, name, rows):
+        # Drop the rows appended after the manifest was last saved.
+        vector_file, hash_file = self._list_files(name)
+        for file, size in ((vector_file, rows * self.dim * 4), (hash_file, rows * np.dtype(HASH_DTYPE).itemsize)):
+            if os.path.exists(file) and os.path.getsize(file) > size:
+                os.truncate(file, size)
+
+    def _read(self, name):
+        """
+        Returns:
+            a tuple (vectors, content hashes) of the rows in a list, memory-mapped.
+        """
+        rows = self.manifest['lists'].get(name, 0)
+        if not rows:
+            return np.empty((0, self.dim), dtype=np.float32), np.empty(0, dtype=HASH_DTYPE)
+        cached = self._lists.get(name)
+        if cached is None or len(cached[1]) != rows:
+            vector_file, hash_file = self._list_files(name)
+            cached = (np.memmap(vector_file, dtype=np.float32, mode='r', shape=(rows, self.dim)),
+                      np.memmap(hash_file, dtype=HASH_DTYPE, mode='r', shape=(rows,)))
+            self._lists[name] = cached
+        return cached
+
+    def _append(self, name, vectors, hashes):
+        vector_file, hash_file = self._list_files(name)
+        with open(vector_file, 'ab') as file:
+            file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(hash_file, 'ab') as file:
+            file.write(hashes.tobytes())
+        self.manifest['lists'][name] = self.manifest['lists'].get(name, 0) + len(hashes)
+
+    @property
+    def n_vectors(self):
+        return self.manifest['n_vectors']
+
+    def project(self, matrix):
+        """
+        Args:
+            matrix: a (sparse) matrix of TF-IDF vectors with `n_features` columns, one per row.
+
+        Returns:
+            an array with the projections of the rows of `matrix` to `dim` dimensions, normalized to unit length.
+        """
+        matrix = sp.csr_matrix(matrix)
+        rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+        hashed = (self._a * matrix.indices.astype(np.uint64) + self._b) % MERSENNE_PRIME
+        # The low bits of every hash pick a dimension, a high bit the sign.
+        columns = (hashed % self.dim).ravel()
+        signs = np.where((hashed >> 30) & 1, -1, 1).ravel()
+        data = np.tile(matrix.data, len(self._a)) * signs
+        projected = sp.csr_matrix((data, (np.tile(rows, len(self._a)), columns)),
+                                  shape=(matrix.shape[0], self.dim), dtype=np.float32).toarray()
+        return normalize(projected, copy=False)
+
+    def add(self, content_hashes, matrix):
+        """
+        Adds documents to the index, skipping the ones that were indexed before.
+
+        Args:
+            content_hashes: the content hashes of the documents.
+            matrix: their TF-IDF vectors, one row per document, e.g. a chunk from `FeatureBuilder.iter_chunks`.
+
+        Returns:
+            the number of documents added.
+        """
+        keep, seen = [], set()
+        for i, content_hash in enumerate(content_hashes):
+            if content_hash not in self.content_hashes and content_hash not in seen:
+                keep.append(i)
+                seen.add(content_hash)
+        if not keep:
+            return 0
+        start = time.perf_counter()
+        hashes = np.array([content_hashes[i] for i in keep], dtype=HASH_DTYPE)
+        vectors = self.project(matrix[keep])
+        if self.centroids is None:
+            self._append(PENDING, vectors, hashes)
+        else:
+            assignments = (vectors @ self.centroids.T).argmax(axis=1)
+            for list_id in np.unique(assignments):
+                rows = assignments == list_id
+                self._append(f'{list_id:05d}', vectors[rows], hashes[rows])
+        self.manifest['n_vectors'] += len(keep)
+        self.content_hashes.update(seen)
+        if self.centroids is None and self.manifest['lists'][PENDING] >= self.train_size:
+            self._train()
+        self._save_manifest()
+        METRICS.observe('similarity_insert_seconds', time.perf_counter() - start)
+        METRICS.inc('documents_indexed', len(keep))
+        return len(keep)
+
+    def _train(self):
+        vectors, hashes = (np.array(array) for array in self._read(PENDING))
+        start = time.perf_counter()
+        centroids = spherical_kmeans(vectors, self.n_lists, seed=self.manifest['settings']['seed'])
+        centroid_file = os.path.join(self.path, 'centroids.npy')
+        with open(centroid_file + '.tmp', 'wb') as file:
+            np.save(file, centroids)
+        os.replace(centroid_file + '.tmp', centroid_file)
+        assignments = (vectors @ centroids.T).argmax(axis=1)
+        for list_id in np.unique(assignments):
+            rows = assignments == list_id
+            self._append(f'{list_id:05d}', vectors[rows], hashes[rows])
+        self.centroids = centroids
+        self.manifest['trained'] = True
+        self.manifest['lists'][PENDING] = 0
+        self._save_manifest()
+        self._truncate(PENDING, 0)
+        self._lists.pop(PENDING, None)
+        logger.info('trained similarity index', extra={'vectors': len(vectors), 'lists': self.n_lists,
+                                                       'seconds': round(time.perf_counter() - start, 3)})
+
+    def build(self, features):
+        """
+        Adds the feature chunks that were not indexed yet.
+
+        Args:
+            features: a `FeatureBuilder`.
+
+        Returns:
+            the number of documents added.
+        """
+        indexed = set(self.manifest['indexed_chunks'])
+        added = 0
+        for chunk, (hashes, matrix) in zip(features.manifest['chunks'], features.iter_chunks()):
+            if chunk['name'] in indexed:
+                continue
+            added += self.add(hashes, matrix)
+            self.manifest['indexed_chunks'].append(chunk['name'])
+            self._save_manifest()
+        return added
+
+    def search(self, matrix, k=10, nprobe=None, exclude=()):
+        """
+        Finds the most similar indexed documents of one or more documents.
+
+        Args:
+            matrix: the TF-IDF vectors of the documents, one row per document, e.g. from `FeatureBuilder.transform`.
+            k (optional): the number of similar documents to return per document.
+            nprobe (optional): the number of lists to scan; more is slower, but misses fewer neighbours.
+            exclude (optional): content hashes to leave out of the results, e.g. those of the documents themselves.
+
+        Returns:
+            a list with, for every document, a list of tuples (content_hash, cosine similarity), most similar first.
+        """
+        return self.search_vectors(self.project(matrix), k=k, nprobe=nprobe, exclude=exclude)
+
+    def search_vectors(self, vectors, k=10, nprobe=None, exclude=()):
+        """
+        Like `search`, for vectors that were projected with `project` already.
+        """
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        results = []
+        for vector in np.atleast_2d(vectors):
+            start = time.perf_counter()
+            if self.centroids is None:
+                names = [PENDING]
+            else:
+                probe = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+                names = [f'{list_id:05d}' for list_id in probe]
+            results.append(self._top_k(vector, names, k, exclude))
+            METRICS.observe('similarity_query_seconds', time.perf_counter() - start)
+        return results
+
+    def exact_search(self, vectors, k=10, exclude=()):
+        """
+        Like `search_vectors`, but compares every vector with all indexed vectors; the baseline of the recall of
+        `search`.
+        """
+        names = [name for name, rows in self.manifest['lists'].items() if rows]
+        return [self._top_k(vector, names, k, exclude) for vector in np.atleast_2d(vectors)]
+
+    def _top_k(self, vector, names, k, exclude):
+        similarities, hashes = [], []
+        for name in names:
+            list_vectors, list_hashes = self._read(name)
+            similarities.append(list_vectors @ vector)
+            hashes.append(list_hashes)
+        similarities = np.concatenate(similarities) if similarities else np.empty(0, dtype=np.float32)
+        hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=HASH_DTYPE)
+        n = min(k + len(exclude), len(similarities))
+        if not n:
+            return []
+        top = np.argpartition(-similarities, n - 1)[:n]
+        top = top[np.argsort(-similarities[top])]
+        matches = [(hashes[i].decode('ascii'), float(similarities[i])) for i in top]
+        return [match for match in matches if match[0] not in exclude][:k]
+
+
+@click.command()
+@click.argument('features_filepath', type=click.Path(exists=True))
+@click.argument('index_filepath', type=click.Path())
+@click.option('--corpus', default=None, type=click.Path(exists=True),
+              help='The corpus store (e.g. data/processed/corpus.sqlite) to look up the --related URLs in.')
+@click.option('--related', multiple=True, help='Print the articles most similar to the one at this URL.')
+@click.option('-k', default=10, help='Number of related articles per URL.')
+@click.option('--lists', default=128, help='Number of lists of a new index.')
+@click.option('--nprobe', default=8, help='Lists of the index to scan per query.')
+def main(features_filepath, index_filepath, corpus, related, k, lists, nprobe):
+    """ Adds the features in FEATURES_FILEPATH (e.g. data/processed/features) that were not indexed yet to the
+        similarity index in INDEX_FILEPATH (e.g. data/processed/similarity), and prints the articles related to
+        the --related URLs as JSON lines.
+    """
+    features = FeatureBuilder(features_filepath)
+    index = SimilarityIndex(index_filepath, n_features=features.n_features, n_lists=lists, nprobe=nprobe)
+    added = index.build(features)
+    logger.info('updated similarity index', extra={'added': added, 'vectors': index.n_vectors})
+    if related and corpus is None:
+        raise click.UsageError('--related needs the --corpus to read the articles from')
+    store = CorpusStore(corpus) if related else None
+    for url in related:
+        document = store.get(url)
+        if document is None or not document['text']:
+            logger.warning('no parsed article', extra={'url': url})
+            continue
+        matches = index.search(features.transform([document['text']]), k=k,
+                               exclude={document['content_hash']})[0]
+        print(json.dumps({'url': url, 'related': [{'content_hash': content_hash, 'similarity': round(similarity, 4)}
+                                                  for content_hash, similarity in matches]}))
+    if store is not None:
+        store.close()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    use_structured_logging()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+import joblib
+import numpy as np
+from src.data.corpus_store import CorpusStore
+from src.data.metrics import METRICS, use_structured_logging
+from src.features.build_features import FeatureBuilder
+
+logger = logging.getLogger(__name__)
+
+
+class ScoreCache:
+    """
+    The topic and confidence of every scored document, by content hash, for one version of the model.
+    Documents are content-addressed, so an unchanged document is never scored twice; scores of
+    earlier model versions are dropped when the cache is opened for a new one. The cache also keeps
+    the `added_at` of the newest document scored, for any version, so that a daily run only has to
+    score the documents added since the last one, see `last_added_at`.
+    """
+
+    def __init__(self, path='../../models/topics/scores.sqlite', model_version=''):
+        self.model_version = str(model_version)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS scores '
+                '(content_hash TEXT NOT NULL, model_version TEXT NOT NULL, topic INTEGER NOT NULL, '
+                'confidence REAL NOT NULL, PRIMARY KEY (content_hash, model_version))')
+            self._connection.execute('DELETE FROM scores WHERE model_version != ?', (self.model_version,))
+            self._connection.execute('CREATE TABLE IF NOT EXISTS progress (name TEXT PRIMARY KEY, value REAL)')
+
+    def get_many(self, content_hashes):
+        """
+        Returns:
+            a dict {content_hash: (topic, confidence)} of the documents among `content_hashes` that were scored.
+        """
+        content_hashes = list(content_hashes)
+        if not content_hashes:
+            return {}
+        with self._lock:
+            rows = self._connection.execute(
+                f'SELECT content_hash, topic, confidence FROM scores WHERE model_version = ? '
+                f'AND content_hash IN ({", ".join("?" * len(content_hashes))})',
+                [self.model_version] + content_hashes).fetchall()
+        return {content_hash: (topic, confidence) for content_hash, topic, confidence in rows}
+
+    def put_many(self, scores):
+        """
+        Stores a dict {content_hash: (topic, confidence)}.
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                                         [(content_hash, self.model_version, int(topic), float(confidence))
+                                          for content_hash, (topic, confidence) in scores.items()])
+
+    def last_added_at(self):
+        """
+        Returns:
+            the `added_at` timestamp of the newest document scored so far, or `None` if none was.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM progress WHERE name = 'last_added_at'").fetchone()
+        return row[0] if row is not None else None
+
+    def set_last_added_at(self, added_at):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO progress VALUES ('last_added_at', ?)", (added_at,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class TopicScorer:
+    """
+    Assigns documents to the topics of the model trained by `TopicTrainer`, with a confidence.
+
+    The model is loaded once, with its arrays (cluster centers or topic-word weights) memory-mapped,
+    and documents are vectorized and scored in batches of `batch_size`. Scores are cached per content
+    hash in a `ScoreCache` for the current model version, so only new documents are ever scored.
+
+    For k-means, the confidence is the margin between the nearest and second nearest cluster center,
+    `1 - d1 / d2`: 0 for a document halfway between two topics, approaching 1 right at a center.
+    For LDA, it is the weight of the most likely topic in the document's topic distribution.
+    """
+
+    def __init__(self, model_path='../../models/topics', features=None, batch_size=256, cache=None):
+        with open(os.path.join(model_path, 'state.json')) as file:
+            state = json.load(file)
+        self.algorithm = state['algorithm']
+        self.model_version = state['n_documents']
+        self.model = joblib.load(os.path.join(model_path, 'model.joblib'), mmap_mode='r')
+        self.features = features if features is not None else FeatureBuilder()
+        self.batch_size = batch_size
+        self.cache = cache if cache is not None else ScoreCache(os.path.join(model_path, 'scores.sqlite'),
+                                                                self.model_version)
+
+    def score_texts(self, texts):
+        """
+        Scores a batch of texts, without using the cache.
+
+        Returns:
+            a tuple of arrays (topics, confidences), with an entry per text.
+        """
+        if self.algorithm == 'kmeans':
+            distances = self.model.transform(self.features.transform(texts))
+            topics = distances.argmin(axis=1)
+            if distances.shape[1] > 1:
+                nearest = np.partition(distances, 1, axis=1)
+                confidences = 1 - nearest[:, 0] / np.maximum(nearest[:, 1], np.finfo(distances.dtype).tiny)
+            else:
+                confidences = np.ones(len(topics))
+        else:
+            distributions = self.model.transform(self.features.count(texts))
+            topics = distributions.argmax(axis=1)
+            confidences = distributions.max(axis=1)
+        return topics, confidences
+
+    def score(self, documents):
+        """
+        Scores a stream of documents in batches, taking the scores of documents that were scored before from the
+        cache.
+
+        Args:
+            documents: an iterable of dicts with (at least) the `content_hash` and `text` of every document, as
+                yielded by `CorpusStore.iter_documents`.
+
+        Yields:
+            the documents, with their `topic` and `confidence` added; documents without text are skipped.
+        """
+        batch = []
+        for document in documents:
+            if not document.get('text'):
+                continue
+            batch.append(document)
+            if len(batch) == self.batch_size:
+                yield from self._score_batch(batch)
+                batch = []
+        if batch:
+            yield from self._score_batch(batch)
+
+    def _score_batch(self, documents):
+        start = time.perf_counter()
+        scores = self.cache.get_many(document['content_hash'] for document in documents)
+        missing = list({document['content_hash']: document for document in documents
+                        if document['content_hash'] not in scores}.values())
+        if missing:
+            topics, confidences = self.score_texts([document['text'] for document in missing])
+            new_scores = {document['content_hash']: (int(topic), float(confidence))
+                          for document, topic, confidence in zip(missing, topics, confidences)}
+            self.cache.put_many(new_scores)
+            scores.update(new_scores)
+        METRICS.inc('documents_scored', len(missing))
+        METRICS.inc('score_cache_hits', len(documents) - len(missing))
+        METRICS.observe('score_batch_seconds', time.perf_counter() - start)
+        for document in documents:
+            topic, confidence = scores[document['content_hash']]
+            yield dict(document, topic=topic, confidence=confidence)
+
+    def score_store(self, store, since=None):
+        """
+        Scores the documents in a `CorpusStore`, e.g. the new documents of a run, and remembers the `added_at` of
+        the newest one in the cache.
+
+        Args:
+            store: the `CorpusStore`.
+            since (optional): only score the documents added after this timestamp, e.g. `cache.last_added_at()`.
+
+        Returns:
+            a list of dicts with the `url`, `content_hash`, `topic` and `confidence` of every document.
+        """
+        documents = store.iter_documents(since=since, fields=('url', 'content_hash', 'text', 'added_at'))
+        tags = []
+        last_added_at = self.cache.last_added_at()
+        for document in self.score(documents):
+            if last_added_at is None or document['added_at'] > last_added_at:
+                last_added_at = document['added_at']
+            tags.append({key: value for key, value in document.items() if key not in ('text', 'added_at')})
+        if last_added_at is not None:
+            self.cache.set_last_added_at(last_added_at)
+        return tags
+
+    def close(self):
+        self.cache.close()
+
+
+@click.command()
+@click.argument('corpus_filepath', type=click.Path(exists=True))
+@click.argument('features_filepath', type=click.Path(exists=True))
+@click.argument('model_filepath', type=click.Path(exists=True))
+@click.option('--since', default=None, type=float,
+              help='Only tag the documents added after this Unix timestamp; by default, the ones added since the '
+                   'last run.')
+@click.option('--all', 'score_all', is_flag=True, help='Tag all documents, and overwrite the --output file.')
+@click.option('--output', default=None, type=click.Path(),
+              help='Append the tags as JSON lines to this file instead of writing them to stdout.')
+@click.option('--batch-size', default=256, help='Documents scored at once.')
+def main(corpus_filepath, features_filepath, model_filepath, since, score_all, output, batch_size):
+    """ Tags the documents added to the corpus store (CORPUS_FILEPATH, e.g. data/processed/corpus.sqlite) since the
+        last run with a topic and confidence from the model in MODEL_FILEPATH (e.g. models/topics), as JSON lines with
+        the url, content hash, topic and confidence.
+    """
+    store = CorpusStore(corpus_filepath)
+    scorer = TopicScorer(model_filepath, features=FeatureBuilder(features_filepath), batch_size=batch_size)
+    if not score_all and since is None:
+        since = scorer.cache.last_added_at()
+    start = time.perf_counter()
+    tags = scorer.score_store(store, since=None if score_all else since)
+    seconds = time.perf_counter() - start
+    file = open(output, 'w' if score_all else 'a') if output is not None else sys.stdout
+    for tag in tags:
+        file.write(json.dumps(tag) + '\n')
+    if output is not None:
+        file.close()
+    logger.info('tagged documents', extra={'documents': len(tags), 'scored': METRICS.counter('documents_scored'),
+                                           'seconds': round(seconds, 3)})
+    scorer.close()
+    store.close()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    use_structured_logging()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    main()
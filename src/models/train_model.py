@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import click
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import joblib
+import scipy.sparse as sp
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import LatentDirichletAllocation
+from src.data.metrics import METRICS, use_structured_logging
+from src.features.build_features import FeatureBuilder
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; memory is not reported there.
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Mini-batch k-means clusters the TF-IDF vectors; online LDA models the raw term counts.
+ALGORITHMS = ('kmeans', 'lda')
+
+
+def peak_memory_mb():
+    """
+    Returns:
+        the peak resident memory of this process in MB so far, or None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def make_model(algorithm, n_topics, random_state=0):
+    if algorithm == 'kmeans':
+        return MiniBatchKMeans(n_clusters=n_topics, random_state=random_state, n_init=1)
+    if algorithm == 'lda':
+        return LatentDirichletAllocation(n_components=n_topics, learning_method='online', random_state=random_state)
+    raise ValueError(f'Unknown algorithm {algorithm!r}, choose from {ALGORITHMS}')
+
+
+class TopicTrainer:
+    """
+    Trains an incremental topic model on the features written by `FeatureBuilder`: mini-batch k-means
+    over the TF-IDF vectors, or online LDA over the term counts. Both are updated with `partial_fit`,
+    one batch of at most `batch_size` documents at a time, so a daily run only trains on the feature
+    chunks that were added since the last one.
+
+    The model is checkpointed to `path` (with joblib) after every feature chunk, together with a
+    state file listing the chunks it was trained on and the time, size and peak memory of every
+    batch. An interrupted run resumes at the first chunk that was not checkpointed.
+    """
+
+    def __init__(self, path='../../models/topics', algorithm='kmeans', n_topics=20, batch_size=1000,
+                 random_state=0):
+        self.path = path
+        self.batch_size = batch_size
+        os.makedirs(path, exist_ok=True)
+        self.model_file = os.path.join(path, 'model.joblib')
+        self.state_file = os.path.join(path, 'state.json')
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as file:
+                self.state = json.load(file)
+            if (self.state['algorithm'], self.state['n_topics']) != (algorithm, n_topics):
+                raise ValueError(f"The model in {path} is {self.state['algorithm']} with {self.state['n_topics']} "
+                                 f"topics, not {algorithm} with {n_topics}")
+            self.model = joblib.load(self.model_file)
+        else:
+            self.state = {'algorithm': algorithm, 'n_topics': n_topics, 'trained_chunks': [], 'n_documents': 0,
+                          'batches': []}
+            self.model = make_model(algorithm, n_topics, random_state)
+        # Mini-batch k-means needs at least one document per cluster in its first batch.
+        self._min_rows = n_topics if algorithm == 'kmeans' and not self.state['n_documents'] else 1
+        self._pending = []
+
+    def train(self, features):
+        """
+        Updates the model with the feature chunks it was not trained on yet.
+
+        Args:
+            features: a `FeatureBuilder`.
+
+        Returns:
+            the statistics of the batches trained in this call: dicts with the number of `rows`, the training
+            `seconds` and the `peak_memory_mb` of the process after the batch.
+        """
+        tfidf = self.state['algorithm'] == 'kmeans'
+        trained = set(self.state['trained_chunks'])
+        batches = []
+        for chunk, (_, matrix) in zip(features.manifest['chunks'], features.iter_chunks(tfidf=tfidf)):
+            if chunk['name'] in trained:
+                continue
+            for start in range(0, matrix.shape[0], self.batch_size):
+                batches.extend(self._partial_fit(matrix[start:start + self.batch_size]))
+            self.state['trained_chunks'].append(chunk['name'])
+            if not self._pending:
+                self._checkpoint()
+        if self._pending:
+            # Too few documents in total to start the first batch; train on them next time.
+            self.state['trained_chunks'] = [name for name in self.state['trained_chunks']
+                                            if name in trained]
+            self._pending = []
+        self.state['batches'].extend(batches)
+        self._save_state()
+        return batches
+
+    def _partial_fit(self, batch):
+        if self._pending or batch.shape[0] < self._min_rows:
+            self._pending.append(batch)
+            batch = sp.vstack(self._pending, format='csr')
+            if batch.shape[0] < self._min_rows:
+                return []
+            self._pending = []
+        start = time.perf_counter()
+        self.model.partial_fit(batch)
+        seconds = time.perf_counter() - start
+        self._min_rows = 1
+        self.state['n_documents'] += batch.shape[0]
+        METRICS.observe('train_batch_seconds', seconds, buckets=(.1, .5, 1, 5, 10, 30, 60, 300))
+        METRICS.inc('documents_trained', batch.shape[0])
+        stats = {'rows': batch.shape[0], 'seconds': round(seconds, 4), 'peak_memory_mb': peak_memory_mb(),
+                 'finished_at': time.time()}
+        logger.info('trained batch', extra=stats)
+        return [stats]
+
+    def _checkpoint(self):
+        # Dump next to the current checkpoint and swap it in, so an interrupted dump never corrupts it.
+        joblib.dump(self.model, self.model_file + '.tmp')
+        os.replace(self.model_file + '.tmp', self.model_file)
+        self._save_state()
+
+    def _save_state(self):
+        with open(self.state_file + '.tmp', 'w') as file:
+            json.dump(self.state, file)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+
+@click.command()
+@click.argument('features_filepath', type=click.Path(exists=True))
+@click.argument('model_filepath', type=click.Path())
+@click.option('--algorithm', type=click.Choice(ALGORITHMS), default='kmeans')
+@click.option('--topics', default=20, help='Number of topics (clusters).')
+@click.option('--batch-size', default=1000, help='Documents per partial_fit call.')
+def main(features_filepath, model_filepath, algorithm, topics, batch_size):
+    """ Updates the topic model in MODEL_FILEPATH (e.g. models/topics) with the features in FEATURES_FILEPATH
+        (e.g. data/processed/features) it was not trained on yet.
+    """
+    trainer = TopicTrainer(model_filepath, algorithm=algorithm, n_topics=topics, batch_size=batch_size)
+    batches = trainer.train(FeatureBuilder(features_filepath))
+    logger.info('trained topic model', extra={'batches': len(batches), 'documents': sum(b['rows'] for b in batches),
+                                              'seconds': round(sum(b['seconds'] for b in batches), 3),
+                                              'peak_memory_mb': peak_memory_mb(),
+                                              'total_documents': trainer.state['n_documents']})
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    use_structured_logging()
+
+    # not used in this stub but often useful for finding various files
+    project_dir = Path(__file__).resolve().parents[2]
+
+    main()
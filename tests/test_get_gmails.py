@@ -0,0 +1,106 @@
+import httplib2
+import pytest
+from googleapiclient import errors
+
+from benchmarks.synthetic import FakeGmailService, _Request, make_mailbox
+from src.data.get_gmails import GMailGetter
+
+
+def http_error(status, reason=''):
+    content = f'{{"error": {{"code": {status}, "errors": [{{"reason": "{reason}"}}]}}}}'.encode('utf-8')
+    return errors.HttpError(httplib2.Response({'status': status}), content)
+
+
+class FailingGmailService(FakeGmailService):
+    """
+    A `FakeGmailService` whose gets of the messages in `failures` raise the errors listed for them, one per
+    attempt, before they succeed. The number of gets of every message is counted in `gets`.
+    """
+
+    def __init__(self, mailbox, failures=None):
+        super().__init__(mailbox)
+        self.failures = {msg_id: list(errors) for msg_id, errors in (failures or {}).items()}
+        self.gets = {}
+
+    def get(self, userId, id, format='full'):
+        def execute():
+            self.gets[id] = self.gets.get(id, 0) + 1
+            if self.failures.get(id):
+                raise self.failures[id].pop(0)
+            return self.mailbox[id]
+        return _Request(self, execute)
+
+
+@pytest.fixture
+def mailbox():
+    return make_mailbox(120, n_words=20, n_links=2)
+
+
+def fetch(service, **kwargs):
+    getter = GMailGetter(service=service, run_pipeline=False)
+    messages = [{'id': msg_id} for msg_id in service.mailbox]
+    return getter, [message['id'] for message in getter.fetch_messages(messages, backoff=0, **kwargs)]
+
+
+def test_fetches_every_message_in_batches(mailbox):
+    service = FailingGmailService(mailbox)
+    getter, fetched = fetch(service, batch_size=50)
+    assert fetched == list(mailbox)
+    assert service.round_trips == 3
+    assert getter.fetch_errors == {}
+
+
+@pytest.mark.parametrize('error', [http_error(429), http_error(403, 'userRateLimitExceeded')])
+def test_retries_rate_limited_messages(mailbox, error):
+    msg_id = list(mailbox)[7]
+    service = FailingGmailService(mailbox, failures={msg_id: [error, error]})
+    getter, fetched = fetch(service, batch_size=50)
+    assert sorted(fetched) == sorted(mailbox)
+    assert service.gets[msg_id] == 3
+    assert getter.fetch_errors == {}
+
+
+def test_gives_up_after_max_retries(mailbox):
+    msg_id = list(mailbox)[7]
+    service = FailingGmailService(mailbox, failures={msg_id: [http_error(429)] * 10})
+    getter, fetched = fetch(service, batch_size=50, max_retries=2)
+    assert msg_id not in fetched
+    assert len(fetched) == len(mailbox) - 1
+    assert service.gets[msg_id] == 3
+    assert list(getter.fetch_errors) == [msg_id]
+
+
+def test_records_other_failures_without_retrying(mailbox):
+    msg_ids = list(mailbox)[:2]
+    service = FailingGmailService(mailbox, failures={msg_ids[0]: [http_error(403, 'insufficientPermissions')],
+                                                     msg_ids[1]: [http_error(500)]})
+    getter, fetched = fetch(service, batch_size=50)
+    assert fetched == list(mailbox)[2:]
+    assert service.gets == {msg_id: 1 for msg_id in mailbox}
+    assert sorted(getter.fetch_errors) == sorted(msg_ids)
+
+
+def test_skips_deleted_messages(mailbox):
+    msg_id = list(mailbox)[7]
+    service = FailingGmailService(mailbox, failures={msg_id: [http_error(404)]})
+    getter, fetched = fetch(service, batch_size=50)
+    assert msg_id not in fetched
+    assert len(fetched) == len(mailbox) - 1
+    assert getter.fetch_errors == {}
+
+
+def test_records_every_message_of_a_failed_batch(mailbox):
+    class BrokenBatchService(FailingGmailService):
+        def new_batch_http_request(self, callback=None):
+            batch = super().new_batch_http_request(callback)
+            if self.round_trips == 0:
+                def execute():
+                    self._round_trip()
+                    raise http_error(500)
+                batch.execute = execute
+            return batch
+
+    service = BrokenBatchService(mailbox)
+    getter, fetched = fetch(service, batch_size=50)
+    assert fetched == list(mailbox)[50:]
+    assert sorted(getter.fetch_errors) == list(mailbox)[:50]